@@ -41,7 +41,8 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
     # configuration files can be provided to generate the parameters required
     # by App.
     def launch(self, tool_class,  # pylint: disable=too-many-locals,arguments-differ
-               config_path, input_metadata_path, output_metadata_path):
+               config_path, input_metadata_path, output_metadata_path,
+               arguments=None):
         """
         Run a Tool with the specified inputs and configuration.
 
@@ -60,6 +61,9 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
         output_metadata_path : str
             path to write the JSON file containing information on tool outputs.
             The schema for this JSON string is the "output_metadata.json".
+        arguments : dict
+            tool arguments overriding those found in config.json (e.g., given
+            in the command line).
 
 
         Returns
@@ -79,8 +83,10 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
         """
 
         logger.info("0) Unpack information from JSON")
-        input_ids, arguments, output_files = self._read_config(
+        input_ids, config_arguments, output_files = self._read_config(
             config_path)
+        config_arguments.update(arguments or {})
+        arguments = config_arguments
 
         input_metadata_ids = self._read_metadata(
             input_metadata_path)
@@ -97,13 +103,92 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
         # Metadata keys to use in the VRE runner
         # -------------------
         input_metadata['output_folder'] = arguments['execution']
+        # Bin widths and normalize flags are lists, so that several settings
+        # can be swept in the same run (e.g., "25, 50" or [25, 50])
         try:
-            input_metadata['bin_width'] = int(arguments['bin_width '])
+            input_metadata['bin_width'] = [
+                int(v) if float(v).is_integer() else float(v)
+                for v in self._as_list(arguments['bin_width'])]
+            assert len(input_metadata['bin_width']) > 0
         except:
             print('''WARNING: Could not understand bin width. Please,
                   provide a valid integer. Setting a default bin width of
                   25.''')
-            input_metadata['bin_width'] = 25
+            input_metadata['bin_width'] = [25]
+        input_metadata['normalize'] = [
+            str(v).lower() in ['true', '1', 'yes']
+            for v in self._as_list(arguments.get('normalize', False))] or [False]
+        # Number of worker processes of each task. Default (None) shares the
+        # available cores between the tasks.
+        try:
+            input_metadata['workers'] = int(arguments['workers'])
+        except KeyError:
+            input_metadata['workers'] = None
+        except ValueError:
+            print('''WARNING: Could not understand number of workers. Please,
+                  provide a valid integer. Using all available cores.''')
+            input_metadata['workers'] = None
+        # Number of extraction tasks the images are split in (e.g., one per
+        # node with PyCOMPSs). Each task uses `workers` processes.
+        try:
+            input_metadata['tasks'] = int(arguments['tasks'])
+        except KeyError:
+            input_metadata['tasks'] = 1
+        except ValueError:
+            print('''WARNING: Could not understand number of tasks. Please,
+                  provide a valid integer. Using a single task.''')
+            input_metadata['tasks'] = 1
+        # Memory budget (MB) of the decoded volume cache of each process
+        try:
+            input_metadata['cache_size'] = float(arguments['cache_size'])
+        except KeyError:
+            input_metadata['cache_size'] = None
+        except ValueError:
+            print('''WARNING: Could not understand volume cache size. Please,
+                  provide a valid number of MB. Using default size.''')
+            input_metadata['cache_size'] = None
+        # Continue an interrupted run from its checkpoint
+        input_metadata['resume'] = str(arguments.get('resume', False)).lower() in \
+            ['true', '1', 'yes']
+        # Format of the results file (csv, parquet or feather)
+        input_metadata['output_format'] = str(arguments.get('output_format', 'csv')).lower()
+        # Data type of the image voxels (e.g., float32). Default keeps the one
+        # stored on disk.
+        input_metadata['dtype'] = arguments.get('dtype') or None
+        # Use the spacing, origin and direction of the NIfTI affine
+        input_metadata['geometry'] = str(arguments.get('geometry', True)).lower() in \
+            ['true', '1', 'yes']
+        # Scratch directory where gzipped inputs are decompressed, and its
+        # size cap (MB)
+        input_metadata['scratch_dir'] = arguments.get('scratch_dir') or None
+        try:
+            input_metadata['scratch_size'] = float(arguments['scratch_size'])
+        except KeyError:
+            input_metadata['scratch_size'] = None
+        except ValueError:
+            print('''WARNING: Could not understand scratch size. Please,
+                  provide a valid number of MB. Using default size.''')
+            input_metadata['scratch_size'] = None
+        # Persistent cache of features reused across runs, and its size cap (MB)
+        input_metadata['feature_cache'] = str(arguments.get('feature_cache', True)).lower() in \
+            ['true', '1', 'yes']
+        try:
+            input_metadata['feature_cache_size'] = float(arguments['feature_cache_size'])
+        except KeyError:
+            input_metadata['feature_cache_size'] = None
+        except ValueError:
+            print('''WARNING: Could not understand feature cache size. Please,
+                  provide a valid number of MB. Using default size.''')
+            input_metadata['feature_cache_size'] = None
+        # Feature classes and individual features to extract (e.g.,
+        # "firstorder glcm" and "glszm_ZoneEntropy"). Default extracts those
+        # enabled in Params.yaml.
+        input_metadata['feature_classes'] = self._as_list(
+            arguments.get('feature_classes', [])) or None
+        input_metadata['features'] = self._as_list(arguments.get('features', [])) or None
+        # Only estimate the cost of the job, without running it
+        input_metadata['plan'] = str(arguments.get('plan', False)).lower() in \
+            ['true', '1', 'yes']
         # Get label names and ED and ES positions, if available
         label_names = []
         slicing_points = []
@@ -131,7 +216,11 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
         for role, metadata in input_metadata.items():
             if role in ['images', 'masks']:
                 input_files[role] = [el.file_path for el in metadata]
-            elif role in ['output_folder', 'bin_width', 'label_names', 'slicing_points']:
+            elif role in ['output_folder', 'bin_width', 'normalize', 'workers', 'tasks',
+                          'cache_size', 'resume', 'output_format', 'dtype', 'geometry', 'scratch_dir',
+                          'scratch_size', 'feature_cache', 'feature_cache_size',
+                          'feature_classes', 'features', 'plan', 'label_names',
+                          'slicing_points']:
                 # Ignore keys introduced in the previous step
                 continue
             else:
@@ -149,6 +238,16 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
             output_files, output_metadata,
             output_metadata_path)
 
+    @staticmethod
+    def _as_list(value):
+        """
+        Values of an argument given either as a JSON list or as a string of
+        comma or space separated values.
+        """
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return str(value).replace(',', ' ').split()
+
     def _read_config(self, json_path):  # pylint: disable=no-self-use
         """
         Read config.json to obtain:
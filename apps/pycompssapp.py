@@ -49,6 +49,13 @@ class PyCOMPSsApp(App):  # pylint: disable=too-few-public-methods
         # The compss_wait_on performs a synchronization and retrieves the
         # content from output_files. Then it is possible to perform any
         # post operation like storing the results somewhere.
+        # Values of the output metadata returned by tasks (e.g., statistics
+        # of the extraction) are futures until their task has finished.
+        for meta in output_metadata.get('output_files', []):
+            if isinstance(getattr(meta, 'meta_data', None), dict):
+                meta.meta_data = {
+                    key: compss_wait_on(value) for key, value in meta.meta_data.items()
+                }
         output_files, output_metadata = super(PyCOMPSsApp, self)._post_run(
             tool_instance,
             output_files,
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# -----------------------------------------------------------------------------
+# Long-running extraction service
+# -----------------------------------------------------------------------------
+import os
+import sys
+import hmac
+import json
+import stat
+import uuid
+import signal
+import secrets
+import tempfile
+import threading
+import collections
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import logger
+
+"""
+Long-running service running VRE jobs in a warm process.
+
+Jobs are submitted as JSON over HTTP, on a Unix socket or on localhost, with
+the same contents as the config.json and in_metadata.json files of a job, and
+are launched with the same function as main.py (JSONApp and RAD_RUNNER), in
+this process, one after the other. Hence the scientific stack is imported
+once, and extractors, worker processes and volume caches are reused across
+jobs. The outputs of a job are written to its folder in the workdir.
+
+The Unix socket (by default, service.sock in the workdir) is only accessible
+to the user running the service. On localhost, every request must give the
+token written to the token file of the workdir, as an "Authorization: Bearer
+<token>" header. Submissions must be sent as application/json.
+
+Endpoints:
+
+    GET  /health               status of the service
+    GET  /jobs                 status of the jobs
+    POST /jobs                 submit a job: {"config": ..., "in_metadata": ...,
+                               "arguments": {...}}, with the contents of the
+                               JSON files of the job. Add ?wait=1 to stream
+                               the job events.
+    GET  /jobs/<id>            status, error and results (the output metadata)
+                               of a job
+    GET  /jobs/<id>/events     stream of the log lines of a job, as JSON lines,
+                               ending with its status and results
+"""  # pylint: disable=pointless-string-statement
+
+FINAL_STATES = ('finished', 'failed')
+# Finished jobs kept in memory, with their logs
+MAX_FINISHED_JOBS = 100
+# Arguments set by the service: the outputs of a job go to its folder, and no
+# scratch directory is used, as its .nii files are removed when it is full
+RESERVED_ARGUMENTS = ('execution', 'scratch_dir')
+
+
+class Job(object):
+    """
+    Job submitted to the service, with its log and results.
+    """
+
+    def __init__(self, job_id, folder):
+        self.id = job_id  # pylint: disable=invalid-name
+        self.folder = folder
+        self.status = 'queued'
+        self.error = None
+        self.results = None
+        self.lines = []
+        self._partial = ''
+        self._cond = threading.Condition()
+
+    def write(self, text):
+        """
+        Add the text written by the job to its log, line by line.
+        """
+        with self._cond:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+            if lines:
+                self.lines.extend(lines)
+                self._cond.notify_all()
+
+    def set_status(self, status, results=None, error=None):
+        """
+        Update the status of the job, waking up its event streams.
+        """
+        with self._cond:
+            if status in FINAL_STATES and self._partial:
+                self.lines.append(self._partial)
+                self._partial = ''
+            self.status = status
+            self.results = results
+            self.error = error
+            self._cond.notify_all()
+
+    def summary(self):
+        """
+        Status, error and results of the job.
+        """
+        return {'id': self.id, 'status': self.status, 'error': self.error,
+                'results': self.results}
+
+    def events(self):
+        """
+        Iterate over the log lines of the job as they are written, and then
+        over its summary, once it has finished.
+        """
+        k = 0
+        while True:
+            with self._cond:
+                while k >= len(self.lines) and self.status not in FINAL_STATES:
+                    self._cond.wait()
+                lines = self.lines[k:]
+                k += len(lines)
+                done = self.status in FINAL_STATES and k >= len(self.lines)
+            for line in lines:
+                yield {'log': line}
+            if done:
+                yield self.summary()
+                return
+
+
+class JobOutput(object):
+    """
+    Output stream of the service. The text written by the threads running a
+    job is also added to the log of that job.
+    """
+
+    def __init__(self, stream, jobs_by_thread):
+        self.stream = stream
+        self._jobs_by_thread = jobs_by_thread
+
+    def write(self, text):
+        """
+        Write text to the stream, and to the log of the job of this thread.
+        """
+        job = self._jobs_by_thread.get(threading.get_ident())
+        if job is not None:
+            job.write(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ExtractionService(object):
+    """
+    Queue of VRE jobs, launched in this process one after the other, as a
+    job changes the working directory of the process.
+    """
+
+    def __init__(self, launch, workdir=None):
+        """
+        Parameters
+        ----------
+        launch : function
+            launches a job from the paths of its config.json, in_metadata.json
+            and output metadata, and the arguments overriding its config
+            (e.g., main.main_json)
+        workdir : str
+            folder of the files of the submitted jobs. Default, a temporary
+            folder.
+        """
+        self.launch = launch
+        self.workdir = workdir or tempfile.mkdtemp(prefix='vre_radiomics_service_')
+        self.token = None
+        self._jobs = collections.OrderedDict()
+        self._jobs_by_thread = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        sys.stdout = JobOutput(sys.stdout, self._jobs_by_thread)
+        sys.stderr = JobOutput(sys.stderr, self._jobs_by_thread)
+
+    def warm_up(self):
+        """
+        Import the App, the Tool and the scientific stack, parse the default
+        parameter file, and keep the worker processes of the extractions alive
+        between jobs.
+        """
+        import apps.jsonapp  # pylint: disable=unused-import
+        import tool.VRE_RAD  # pylint: disable=unused-import
+        import extract_radiomics
+        # Tasks of a job run in the thread of the job, so that its log is
+        # streamed (unless another runtime is set in the environment)
+        from utils import dummy_pycompss
+
+        extract_radiomics.keep_worker_pools()
+        extract_radiomics.get_extractor(extract_radiomics.PARAMS_FILE, 25, False)
+        if dummy_pycompss.EXECUTOR_ENV not in os.environ:
+            dummy_pycompss.configure('sync')
+
+    def submit(self, request):
+        """
+        Queue a job.
+
+        Parameters
+        ----------
+        request : dict
+            {"config": ..., "in_metadata": ..., "arguments": {...}}; config and
+            in_metadata are the contents of the JSON files of the job
+
+        Returns
+        -------
+        Job
+        """
+        if not isinstance(request, dict) or 'config' not in request or \
+                'in_metadata' not in request:
+            raise ValueError('A job must give its config and in_metadata')
+        for key in ('config', 'in_metadata'):
+            if not isinstance(request[key], (dict, list)):
+                raise ValueError('The {} of a job must be the contents of its JSON '
+                                 'file'.format(key))
+        arguments = request.get('arguments') or {}
+        if not isinstance(arguments, dict):
+            raise ValueError('The arguments of a job must be an object')
+        reserved = [name for name in RESERVED_ARGUMENTS if name in arguments]
+        if reserved:
+            raise ValueError('The arguments {} are set by the service'.format(
+                ', '.join(reserved)))
+
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, os.path.join(self.workdir, job_id))
+        os.makedirs(job.folder)
+        arguments = dict(arguments, execution=job.folder, scratch_dir=None)
+        paths = []
+        for key in ('config', 'in_metadata'):
+            path = os.path.join(job.folder, key + '.json')
+            with open(path, 'w') as f:
+                json.dump(request[key], f)
+            paths.append(path)
+        paths.append(os.path.join(job.folder, 'out_metadata.json'))
+
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [k for k, j in self._jobs.items() if j.status in FINAL_STATES]
+            for k in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self._jobs[k]
+        logger.info("Job {} queued", job.id)
+        self._pool.submit(self._run, job, paths, arguments)
+        return job
+
+    def _run(self, job, paths, arguments):
+        config, in_metadata, out_metadata = paths
+        self._jobs_by_thread[threading.get_ident()] = job
+        job.set_status('running')
+        try:
+            self.launch(config, in_metadata, out_metadata, dict(arguments))
+            with open(out_metadata) as f:
+                results = json.load(f)
+            job.set_status('finished', results=results)
+        except Exception as error:  # pylint: disable=broad-except
+            job.set_status('failed', error=str(error))
+        finally:
+            del self._jobs_by_thread[threading.get_ident()]
+        logger.info("Job {} {}", job.id, job.status)
+
+    def get(self, job_id):
+        """
+        Job with the given id, or None.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        """
+        Status of the jobs.
+        """
+        with self._lock:
+            return [{'id': job.id, 'status': job.status} for job in self._jobs.values()]
+
+    def serve(self, port=None, socket_path=None):
+        """
+        Serve the API until interrupted: on localhost, if a port is given, with
+        a new token written to the token file of the workdir, or else on a
+        Unix socket (by default, service.sock in the workdir).
+        """
+        handler = type('Handler', (RequestHandler,), {'service': self})
+        if port is None:
+            socket_path = socket_path or os.path.join(self.workdir, 'service.sock')
+            if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                os.remove(socket_path)
+            server = UnixHTTPServer(socket_path, handler)
+            os.chmod(socket_path, 0o600)
+            address = socket_path
+        else:
+            socket_path = None
+            self.token = secrets.token_urlsafe(32)
+            token_file = os.path.join(self.workdir, 'token')
+            fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.token)
+            server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+            address = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            logger.info("Requests must give the token of {}", token_file)
+        logger.info("Extraction service listening on {} (workdir {})", address, self.workdir)
+        # Stop cleanly when terminated, as when interrupted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._pool.shutdown()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server on a Unix socket, a thread per request.
+    """
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Requests of the extraction service API.
+    """
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # The request line is not a format string of the logger
+        logger.debug("{} {}", self.address_string(), format % args)
+
+    def _authorized(self):
+        # Only the token holders may use a TCP service; the Unix socket is
+        # only accessible to the user running it
+        token = self.service.token
+        if token is None:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', '').encode(),
+                                   'Bearer {}'.format(token).encode())
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for event in job.events():
+            self.wfile.write(json.dumps(event).encode() + b'\n')
+            self.wfile.flush()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Status of the service and of the jobs, and job event streams.
+        """
+        if not self._authorized():
+            return self._send_json(401, {'error': 'Missing or wrong token'})
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['health']:
+            return self._send_json(200, {
+                'status': 'ok', 'pid': os.getpid(), 'jobs': len(self.service.jobs())})
+        if parts == ['jobs']:
+            return self._send_json(200, self.service.jobs())
+        if len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.service.get(parts[1])
+            if job is None:
+                return self._send_json(404, {'error': 'Unknown job {}'.format(parts[1])})
+            if len(parts) == 2:
+                return self._send_json(200, job.summary())
+            if parts[2] == 'events':
+                return self._send_events(job)
+        return self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Job submissions.
+        """
+        if not self._authorized():
+            return self._send_json(401, {'error': 'Missing or wrong token'})
+        path, _, query = self.path.partition('?')
+        if [p for p in path.split('/') if p] != ['jobs']:
+            return self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+        if self.headers.get_content_type() != 'application/json':
+            return self._send_json(415, {'error': 'Jobs must be sent as application/json'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = self.service.submit(json.loads(self.rfile.read(length).decode() or 'null'))
+        except (ValueError, OSError) as error:
+            return self._send_json(400, {'error': str(error)})
+        if 'wait=1' in query.split('&') or 'wait=true' in query.split('&'):
+            return self._send_events(job)
+        return self._send_json(202, job.summary())
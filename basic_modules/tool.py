@@ -77,6 +77,9 @@ class Tool(object):  # pylint: disable=too-few-public-methods
         if configuration is None:
             configuration = {}
 
+        # Each instance gets its own copy, so tools run in the same process
+        # (e.g., batch jobs) do not share their configuration
+        self.configuration = dict(self.configuration)
         self.configuration.update(configuration)
 
     # @constraint()
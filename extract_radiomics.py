@@ -1,14 +1,29 @@
 import os, re
-import shutil
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import tempfile
 import time, six
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
-import pandas as pd
 import nibabel as nib
 import SimpleITK as sitk
 
+import radiomics
 from radiomics import featureextractor
 
+from utils import volume_cache as vc
+from utils.checkpoint import CheckpointStore
+from utils import feature_cache as fc
+from utils import roi_index
+from utils import cost_model as cm
+
 # ------ remove warning log from GLCM features computation ------
 import logging
 # set level for all classes
@@ -19,46 +34,997 @@ logger.setLevel(logging.ERROR)
 # logger.setLevel(logging.ERROR)
 # -----------------------------
 
+# Local folder for files reused across runs (e.g., feature schemas)
+CACHE_DIR = os.environ.get(
+    'VRE_RADIOMICS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'vre_radiomics'))
+
+# Supported output formats: file extension and VRE file type
+OUTPUT_FORMATS = {
+    'csv': ('csv', 'CSV'),
+    'parquet': ('parquet', 'PARQUET'),
+    'feather': ('feather', 'FEATHER'),
+}
+# Compression codec of the columnar output formats
+OUTPUT_COMPRESSION = 'zstd'
+
+# Parameter file of the feature extractor
+PARAMS_FILE = os.path.join(os.path.realpath(os.path.dirname(__file__)), 'Params.yaml')
+# Memory used by a worker process before loading any volume (interpreter,
+# NumPy, SimpleITK and pyradiomics), in bytes
+BASE_RSS = 200 * 2**20
+
+# Extractors already configured in this process. Parsing and validating the
+# parameter file is done once per file; each (binWidth, normalize) setting is a
+# copy of that parsed extractor.
+_base_extractors = {}
+_extractors = {}
+# The parameter file parser of pyradiomics is not thread-safe (e.g., jobs of a
+# batch run at the same time)
+_extractors_lock = threading.Lock()
+
+# Feature classes that only depend on the mask. They are computed once per
+# (mask, label) and shared by all the frames of the images using that mask.
+MASK_FEATURE_CLASSES = ('shape', 'shape2D')
+
+# Cost coefficients of the feature classes, learned from previous runs
+COST_MODEL_FILE = os.path.join(CACHE_DIR, 'cost_model.json')
+# Parallel runs split the frames in this many chunks per worker, so that the
+# most expensive ones can be dispatched first
+CHUNKS_PER_WORKER = 4
+# Entries kept by each of the per-mask caches of this process (least recently
+# used ones are dropped)
+MAX_CACHED_MASKS = 256
+_caches_lock = threading.Lock()
+# Mask-only features, by mask content (voxels and geometry), label and settings
+_mask_features = collections.OrderedDict()
+# Content hashes of the masks, used as keys of the persistent feature cache
+_mask_digests = collections.OrderedDict()
+# Voxel counts and bounding boxes of the labels of the masks
+_mask_indexes = collections.OrderedDict()
+# Intensity ranges of the images, from their headers
+_image_ranges = collections.OrderedDict()
+
+
+def _memoize(cache, key, compute, max_entries=MAX_CACHED_MASKS):
+    '''
+    Value of key in a bounded LRU cache (an OrderedDict), computed and added
+    if missing.
+    '''
+    with _caches_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = compute()
+    with _caches_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+    return value
+
+
+class ClassCounters(threading.local):
+    '''
+    Seconds spent computing each feature class, and work units computed (see
+    utils.cost_model), by the current thread, so that extractions running at
+    the same time (e.g., local tasks) only count their own.
+    '''
+
+    def __init__(self):
+        self.timings = collections.Counter()
+        self.work = collections.Counter()
+
+
+class_counters = ClassCounters()  # pylint: disable=invalid-name
+
+
+class TimedFeatureExtractor(featureextractor.RadiomicsFeatureExtractor):
+    '''
+    Feature extractor that computes one feature class at a time and adds the
+    time spent on each one to class_counters.
+    Extractors are shared by the threads of a process, so each class is
+    computed by a shallow copy enabling only that class.
+    '''
+
+    def _timed(self, shape, method, *args, **kwargs):
+        result = collections.OrderedDict()
+        for class_name, features in six.iteritems(self.enabledFeatures):
+            if class_name.startswith('shape') != shape:
+                continue
+            single = copy.copy(self)
+            single.enabledFeatures = {class_name: features}
+            compute = getattr(super(TimedFeatureExtractor, single), method)
+            time_start = time.time()
+            result.update(compute(*args, **kwargs))
+            class_counters.timings[class_name] += time.time() - time_start
+        return result
+
+    def computeShape(self, image, mask, boundingBox, **kwargs):
+        return self._timed(True, 'computeShape', image, mask, boundingBox, **kwargs)
+
+    def computeFeatures(self, image, mask, imageTypeName, **kwargs):
+        return self._timed(False, 'computeFeatures', image, mask, imageTypeName, **kwargs)
+
+
+def feature_selection(feature_classes=None, features=None):
+    '''
+    Check a selection of feature classes and individual features against the
+    pyradiomics registry, and return it in the form expected by get_extractor
+    (None if nothing is selected). Raises an exception listing every unknown
+    name.
+    Params:
+        feature_classes: names of the feature classes to extract (e.g.,
+            ['firstorder', 'shape']), with the features enabled for them in
+            Params.yaml, or all their features if not enabled there.
+        features: names of individual features to extract, prefixed by their
+            class (e.g., ['glcm_Contrast']). Their classes do not need to be
+            listed in feature_classes.
+    '''
+    registry = radiomics.getFeatureClasses()
+    errors = []
+    selected = {}
+    for class_name in feature_classes or []:
+        if class_name not in registry:
+            errors.append('unknown feature class "{}"'.format(class_name))
+            continue
+        # Whole class
+        selected[class_name] = None
+    for name in features or []:
+        class_name, _, feature = re.sub(r'^original_', '', name).partition('_')
+        if class_name not in registry:
+            errors.append('unknown feature class of "{}"'.format(name))
+        elif feature not in registry[class_name].getFeatureNames():
+            errors.append('unknown feature "{}" of class "{}"'.format(feature, class_name))
+        elif class_name not in selected:
+            selected[class_name] = [feature]
+        elif selected[class_name] is not None and feature not in selected[class_name]:
+            selected[class_name].append(feature)
+    if errors:
+        raise Exception('Invalid feature selection: {}. Available feature classes '
+                        'are: {}'.format('; '.join(errors), ', '.join(sorted(registry))))
+
+    if not selected:
+        return None
+    return tuple(sorted(
+        (class_name, tuple(names or ())) for class_name, names in selected.items()))
+
+
+def get_extractor(params, bin_width, normalize, mask_only=None, selection=None):
+    '''
+    Return a configured feature extractor, shared by every label and frame
+    processed in this process.
+    Params:
+        params: path to the pyradiomics parameter file
+        bin_width: width of bins used for the binarization of intensity values
+        normalize: whether or not to normalize the images
+        mask_only: if True, keep only the feature classes that depend only on
+            the mask (MASK_FEATURE_CLASSES); if False, drop them. Default keeps
+            all the enabled classes.
+        selection: feature classes and features to extract instead of the
+            ones enabled in the parameter file, as returned by
+            feature_selection.
+    '''
+    key = (params, bin_width, normalize, mask_only, selection)
+    with _extractors_lock:
+        if key not in _extractors:
+            _extractors[key] = _configure_extractor(
+                params, bin_width, normalize, mask_only, selection)
+    return _extractors[key]
+
+
+def _configure_extractor(params, bin_width, normalize, mask_only, selection):
+    '''
+    Copy of the extractor of a parameter file with the given settings (see
+    get_extractor).
+    '''
+    if params not in _base_extractors:
+        _base_extractors[params] = TimedFeatureExtractor(params)
+    extractor = copy.deepcopy(_base_extractors[params])
+    extractor.settings['binWidth'] = bin_width
+    extractor.settings['normalize'] = normalize
+    if selection is not None:
+        # Classes selected as a whole keep the features of the parameter
+        # file, if any
+        extractor.enabledFeatures = {
+            c: list(f) if f else extractor.enabledFeatures.get(c, [])
+            for c, f in selection
+        }
+    if mask_only is not None:
+        extractor.enabledFeatures = {
+            c: f for c, f in extractor.enabledFeatures.items()
+            if (c in MASK_FEATURE_CLASSES) == mask_only
+        }
+    return extractor
+
+
+def mask_features(params, bin_width, normalize, slc, mk, mask, label, selection=None):
+    '''
+    Features of the mask-only classes for a label of a mask, as returned by
+    pyradiomics. They are computed once per (mask content, label) in this
+    process; the content hash covers the geometry the mask was loaded with.
+    Raises ValueError if the label cannot be extracted.
+    '''
+    def compute():
+        extractor = get_extractor(params, bin_width, normalize, mask_only=True,
+                                  selection=selection)
+        result = {}
+        if len(extractor.enabledFeatures) > 0:
+            result = extractor.execute(slc, mk, label=label)
+            add_work(extractor, mask_index(mask)[label][0], 1)
+        return [(k, v) for k, v in six.iteritems(result) if k[:9] == 'original_']
+
+    key = (mask_digest(mask, mk), label, params, selection)
+    return _memoize(_mask_features, key, compute)
+
+
+def image_range(image):
+    '''
+    Intensity range of an image, from its header (see utils.cost_model).
+    '''
+    stat = os.stat(image)
+    key = (os.path.realpath(image), stat.st_mtime_ns, stat.st_size)
+    return _memoize(
+        _image_ranges, key, lambda: cm.header_range(nib.load(image).header))
+
+
+def extracted_classes(extractor):
+    '''
+    Feature classes actually computed by an extractor.
+    '''
+    return [
+        c for c in extractor.enabledFeatures
+        if c != 'shape2D' or extractor.settings.get('force2D')
+    ]
+
+
+def setting_levels(extractor, intensity_range):
+    '''
+    Estimated number of grey levels of an image for the settings of an
+    extractor. Normalized images span about 6 times normalizeScale.
+    '''
+    if extractor.settings.get('normalize'):
+        intensity_range = 6 * extractor.settings.get('normalizeScale', 1)
+    return cm.grey_levels(intensity_range, extractor.settings['binWidth'])
+
+
+def add_work(extractor, voxels, levels):
+    '''
+    Add the work units of extracting a label to class_counters.
+    '''
+    for class_name in extracted_classes(extractor):
+        class_counters.work[class_name] += cm.work_units(class_name, voxels, levels)
+
+
+def frame_cost(model, extractors, rois, labels, intensity_range):
+    '''
+    Estimated seconds of extracting a frame with a list of extractors (one per
+    setting), per feature class. Mask-only classes are computed once per mask,
+    so they are left out.
+    '''
+    cost = collections.Counter()
+    for extractor in extractors:
+        levels = setting_levels(extractor, intensity_range)
+        for class_name in extracted_classes(extractor):
+            if class_name in MASK_FEATURE_CLASSES:
+                continue
+            cost[class_name] += sum(model.cost(class_name, rois[lb][0], levels)
+                                    for lb in labels if lb in rois)
+    return cost
+
+
+def mask_digest(mask, mk):
+    '''
+    Content hash of a mask, computed once per mask file and geometry in this
+    process.
+    '''
+    stat = os.stat(mask)
+    key = (os.path.realpath(mask), stat.st_mtime_ns, stat.st_size,
+           mk.GetSpacing(), mk.GetOrigin(), mk.GetDirection())
+    return _memoize(_mask_digests, key, lambda: fc.image_digest(mk))
+
+
+def mask_index(mask, mk=None):
+    '''
+    Voxel count and bounding box of every label of a mask (see
+    utils.roi_index), read from the sidecar of the mask when it is fresh, once
+    per mask file in this process.
+    Params:
+        mask: mask filename
+        mk: decoded mask, if available, used when the sidecar is missing
+    '''
+    stat = os.stat(mask)
+    key = (os.path.realpath(mask), stat.st_mtime_ns, stat.st_size)
+
+    def compute():
+        arr = sitk.GetArrayViewFromImage(mk) if mk is not None else None
+        return roi_index.mask_rois(mask, CACHE_DIR, arr)['labels']
+
+    return _memoize(_mask_indexes, key, compute)
+
+
+def can_crop(extractor):
+    '''
+    Whether the features of an extractor are the same when computed on the
+    image and mask cropped around the label. Normalization, resampling and
+    filtered image types use voxels outside the label, so they need the whole
+    image.
+    '''
+    return (
+        not extractor.settings.get('normalize')
+        and extractor.settings.get('resampledPixelSpacing') is None
+        and set(extractor.enabledImagetypes) <= {'Original'}
+    )
+
+
+def crop_roi(img, box):
+    '''
+    Crop a SimpleITK image to a box of its NumPy array, given as (start, stop)
+    pairs in reverse order of the image axes. The origin is updated, so the
+    physical position of the voxels is kept.
+    '''
+    return img[tuple(slice(start, stop) for start, stop in reversed(box))]
 
-def extract_features(tmppath, i, j, colsn, name, slc, mask, labels, bin_width, normalize, params):
 
-    if os.path.exists(os.path.join(tmppath, 'tmp_{0:04d}_{1:03d}.csv'.format(i, j))):
+def feature_schema(extractor, cache_dir=CACHE_DIR):
+    '''
+    Names of the features computed by an extractor on the original image,
+    without the image type prefix (e.g., '_shape_Elongation'), in the order
+    returned by pyradiomics. They are derived from the feature class registry
+    instead of running a sample extraction, and cached on disk keyed by the
+    enabled image types and features and the pyradiomics version.
+    Params:
+        extractor: configured RadiomicsFeatureExtractor
+        cache_dir: folder of the on-disk cache. None disables it.
+    '''
+    key = json.dumps([
+        radiomics.__version__, extractor.enabledImagetypes,
+        extractor.enabledFeatures, bool(extractor.settings.get('force2D'))
+    ], default=str)
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, 'schema', digest + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                return json.load(f)
+
+    names = []
+    if 'Original' in extractor.enabledImagetypes:
+        feature_classes = radiomics.getFeatureClasses()
+        # Shape features are computed first, independently of the image type
+        enabled = sorted(
+            extractor.enabledFeatures.items(),
+            key=lambda item: not item[0].startswith('shape'))
+        for class_name, features in enabled:
+            if class_name not in feature_classes:
+                continue
+            # shape2D is only computed for 3D masks when force2D is set
+            if class_name == 'shape2D' and not extractor.settings.get('force2D'):
+                continue
+            if not features:
+                features = [
+                    name for name, deprecated in
+                    six.iteritems(feature_classes[class_name].getFeatureNames())
+                    if not deprecated
+                ]
+            names.extend('_{}_{}'.format(class_name, name) for name in features)
+
+    if cache_file is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = '{}.{}'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(names, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as err:
+            print('WARNING: could not cache feature schema:', err)
+
+    return names
+
+
+def extract_features(store, i, j, cols, name, slc, mask, labels, settings, params, mk,
+                     cache=None, selection=None):
+    '''
+    Extract radiomics features for a frame of an image, once per (bin_width,
+    normalize) setting, and commit one row per setting to the checkpoint
+    store. Mask-only features are shared by all the settings. The features of
+    each label are looked up in the persistent feature cache first, if given.
+    Labels are extracted from the image and mask cropped to their (padded)
+    bounding box when possible, and labels missing in the mask are skipped.
+    The decoded mask (mk) is loaded by the caller, with the loading options of
+    the extraction.
+    '''
+    settings = [(bw, norm) for bw, norm in settings if not store.done(i, j, bw, norm)]
+    if len(settings) == 0:
         return True
 
-    time_start = time.time()
-    aux = pd.Series(index=colsn, data=np.zeros(len(colsn)))
-    aux['id'] = os.path.basename(name)
-    aux['slice'] = j+1
-    aux['bin_width'] = bin_width
-    aux['normalize'] = normalize
+    index = {c: k for k, c in enumerate(cols)}
     print('Extracting radiomics for:')
     print(' - image: ', name)
     print(' - mask:  ', mask)
-    mk = sitk.GetImageFromArray(nib.load(mask).get_fdata())
+    if cache is not None:
+        digests = (fc.image_digest(slc), mask_digest(mask, mk))
+    rois = mask_index(mask, mk)
+    crops = {}
+    for bin_width, normalize in settings:
+        time_start = time.time()
+        features = np.zeros(len(cols))
+        extractor = get_extractor(params, bin_width, normalize, mask_only=False,
+                                  selection=selection)
+        if cache is not None:
+            extractor_digest = fc.settings_digest(
+                get_extractor(params, bin_width, normalize, selection=selection),
+                radiomics.__version__)
+        crop = can_crop(extractor)
+        for lb in labels:
+            if int(lb) not in rois:
+                print(' label {} not found in the mask, skipped'.format(lb))
+                continue
+            try:
+                values = None
+                if cache is not None:
+                    cache_key = fc.FeatureCache.key(digests[0], digests[1], int(lb), extractor_digest)
+                    values = cache.get(cache_key)
+                if values is None:
+                    roi_img, roi_mk = slc, mk
+                    if crop:
+                        if int(lb) not in crops:
+                            box = roi_index.crop_box(
+                                rois[int(lb)][1], sitk.GetArrayViewFromImage(mk).shape,
+                                pad=extractor.settings.get('padDistance', 5))
+                            crops[int(lb)] = (crop_roi(slc, box), crop_roi(mk, box))
+                        roi_img, roi_mk = crops[int(lb)]
+                    result = extractor.execute(roi_img, roi_mk, label=int(lb))
+                    add_work(extractor, rois[int(lb)][0],
+                             setting_levels(extractor, image_range(name)))
+                    shape = mask_features(
+                        params, bin_width, normalize, roi_img, roi_mk, mask, int(lb),
+                        selection)
+                    values = [
+                        (k, v) for k, v in itertools.chain(six.iteritems(result), shape)
+                        if k[:9] == 'original_'
+                    ]
+                    if cache is not None:
+                        cache.put(cache_key, values)
+                for key, val in values:
+                    col = re.sub(r'original', 'lb{}'.format(int(lb)), key)
+                    if col in index:
+                        features[index[col]] = val
+            except ValueError as err:
+                print(' extraction failed for this label: {}. Error:'.format(lb))
+                print(err)
+                continue
+
+        store.add(i, j, os.path.basename(name), j+1, bin_width, normalize, features)
+        time_end = time.time()
+
+        print('Slice {0:03d} - bin width {1} - normalize {2} - Time {3:.2f} s'.format(
+            j, bin_width, normalize, time_end - time_start))
+
+
+# Worker pool kept alive between extractions of this process (see
+# keep_worker_pools), as ((number of workers, cache size), pool). It is
+# replaced when an extraction uses other ones.
+_kept_pool = None
+_keep_worker_pools = False
+# Extractions using each pool. Pools no longer kept are shut down once unused.
+_pool_users = collections.Counter()
+_worker_pools_lock = threading.Lock()
+
+
+def keep_worker_pools(keep=True):
+    '''
+    Keep the worker processes alive between extractions, so that a
+    long-running process (e.g., the extraction service) reuses their imports,
+    extractors and volume caches. The pool kept so far is shut down when keep
+    is False.
+    '''
+    global _keep_worker_pools, _kept_pool  # pylint: disable=global-statement,invalid-name
+    unused = None
+    with _worker_pools_lock:
+        _keep_worker_pools = keep
+        if not keep and _kept_pool is not None:
+            unused = _retire_pool(_kept_pool[1])
+            _kept_pool = None
+    if unused is not None:
+        unused.shutdown()
+
+
+def _retire_pool(pool):
+    '''
+    Forget a pool that is no longer kept. Returns it, to be shut down, if no
+    extraction is using it.
+    '''
+    if _pool_users[pool] > 0:
+        return None
+    del _pool_users[pool]
+    return pool
+
+
+def _new_pool(workers, cache_size):
+    '''
+    New pool of worker processes, with a volume cache of cache_size MB. The
+    workers are forked from a server that has imported this module, rather
+    than from this process, as pools are also created from threads (local
+    tasks, batch jobs, the extraction service) and forking a process while
+    other threads hold locks leaves them locked in the workers.
+    '''
+    context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=vc.configure,
+        initargs=(cache_size,))
+
+
+def worker_pool(workers, cache_size=None):
+    '''
+    Pool of worker processes with a volume cache of cache_size MB, either a
+    new one or the one kept alive (see keep_worker_pools). It must be given
+    back with release_worker_pool.
+    '''
+    global _kept_pool  # pylint: disable=global-statement,invalid-name
+    key = (workers, cache_size)
+    unused = None
+    with _worker_pools_lock:
+        if not _keep_worker_pools:
+            pool = _new_pool(workers, cache_size)
+        else:
+            if _kept_pool is None or _kept_pool[0] != key:
+                if _kept_pool is not None:
+                    unused = _retire_pool(_kept_pool[1])
+                _kept_pool = (key, _new_pool(workers, cache_size))
+            pool = _kept_pool[1]
+        _pool_users[pool] += 1
+    if unused is not None:
+        unused.shutdown(wait=False)
+    return pool
+
+
+def release_worker_pool(pool, broken=False):
+    '''
+    Give back a pool returned by worker_pool, shutting it down unless it is
+    kept alive and its workers are sound.
+    '''
+    global _kept_pool  # pylint: disable=global-statement,invalid-name
+    with _worker_pools_lock:
+        _pool_users[pool] -= 1
+        kept = _kept_pool is not None and _kept_pool[1] is pool
+        if kept and broken:
+            _kept_pool = None
+        elif kept:
+            return
+        if _retire_pool(pool) is None and not broken:
+            return
+    pool.shutdown(wait=not broken)
+
+
+def available_workers():
+    '''
+    Number of CPU cores available to this process (honouring affinity masks set
+    by the queue system when possible).
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def extract_image(checkpoint, i, frames, cols, image, mask, labels, settings, params,
+                  feature_cache=None, selection=None, loading=()):
+    '''
+    Extract radiomics features for some frames of a single image. The image
+    header and the mask are decoded once and shared by all the frames, and the
+    frames are loaded here so that work items can be shipped to worker
+    processes as plain filenames instead of SimpleITK images.
+    Returns the volume cache hits and misses, the feature cache hits and
+    misses, and the seconds spent and work units computed for each feature
+    class in this call (by this thread).
+    Params:
+        feature_cache: (path, size cap in bytes) of the persistent feature
+            cache. None disables it.
+        selection: feature classes and features to extract (see
+            feature_selection).
+        loading: options of the volumes (see utils.volume_cache.Loading)
+    '''
+    loading = vc.Loading(*loading)
+    scratch = vc.scratch_cache(loading.scratch_dir, loading.scratch_size)
+    hits, misses = vc.volume_cache.thread_counts()
+    timings, work = class_counters.timings.copy(), class_counters.work.copy()
+    store = CheckpointStore(checkpoint)
+    cache = None
+    if feature_cache is not None:
+        cache = fc.FeatureCache(*feature_cache)
+    frames = [
+        j for j in frames
+        if not all(store.done(i, j, bw, norm) for bw, norm in settings)
+    ]
+
+    if len(frames) > 0:
+        mk = vc.volume_cache.get_mask(mask, loading.geometry, scratch)
+    for j in frames:
+        slc = vc.volume_cache.get_image(image, j, loading.dtype, loading.geometry, scratch)
+
+        extract_features(
+            store, i, j, cols, image, slc, mask,
+            labels, settings, params, mk=mk, cache=cache, selection=selection
+        )
+    store.close()
+    cache_hits, cache_misses = 0, 0
+    if cache is not None:
+        cache_hits, cache_misses = cache.hits, cache.misses
+        cache.close()
+
+    hits_end, misses_end = vc.volume_cache.thread_counts()
+    return (hits_end - hits, misses_end - misses, cache_hits, cache_misses, class_counters.timings - timings,
+            class_counters.work - work)
+
+
+def result_chunks(store, colsn, chunk_size=10000):
+    '''
+    Iterate over the rows of a checkpoint store as DataFrames of at most
+    chunk_size rows, sorted by image, frame and setting. Feature values are copied into
+    a preallocated NumPy buffer, so memory is bounded by the chunk size and not
+    by the number of work items.
+    Params:
+        store: CheckpointStore with the extracted rows
+        colsn: output columns (id, slice, bin_width, normalize and features)
+        chunk_size: maximum number of rows of each DataFrame
+    '''
+    # pandas is only needed to write the results, not by the worker processes
+    import pandas as pd
+
+    n_rows = len(store)
+    chunk_size = max(1, min(chunk_size, n_rows))
+    features = np.empty((chunk_size, len(colsn) - 4))
+    names = np.empty(chunk_size, dtype=object)
+    slices = np.empty(chunk_size, dtype=int)
+    bin_widths = np.empty(chunk_size)
+    normalizes = np.empty(chunk_size, dtype=bool)
+
+    def chunk(start, n):
+        df = pd.DataFrame(features[:n], columns=colsn[4:], index=range(start, start+n))
+        df.insert(0, colsn[3], normalizes[:n])
+        df.insert(0, colsn[2], bin_widths[:n])
+        df.insert(0, colsn[1], slices[:n])
+        df.insert(0, colsn[0], names[:n])
+        return df
+
+    start, k = 0, 0
+    for _, _, name, slc, bw, norm, values in store.rows():
+        names[k], slices[k], bin_widths[k], normalizes[k] = name, slc, bw, norm
+        features[k] = values
+        k += 1
+        if k == chunk_size:
+            yield chunk(start, k)
+            start, k = start + k, 0
+    if k > 0 or n_rows == 0:
+        yield chunk(start, k)
+
+
+def sweep_settings(bin_width, normalize):
+    '''
+    List of (bin_width, normalize) settings to extract every work item with,
+    given single values or lists of values to sweep.
+    '''
+    bin_widths = bin_width if isinstance(bin_width, (list, tuple)) else [bin_width]
+    normalizes = normalize if isinstance(normalize, (list, tuple)) else [normalize]
+    return list(itertools.product(bin_widths, normalizes))
+
+
+def select_frames(images, slices_of_interest):
+    '''
+    Frames of each image to extract, read from the image headers: the only
+    frame of 3D images and the slices of interest of 4D ones (all of them if
+    None).
+    '''
+    frames = []
+    for i, image in enumerate(images):
+        nii = nib.load(image)
+        slc_num = 1 if len(nii.shape) == 3 else nii.shape[-1]
+        # Set slices of interest. Default is all slices.
+        soi = slices_of_interest[i]
+        slc_selected = soi if soi is not None else range(slc_num)
+
+        # Iterate over each temporal slice in case it is available. Skip if
+        # slice is not among selected slices
+        frames.append([
+            j for j in range(slc_num) if slc_num == 1 or j in slc_selected
+        ])
+    return frames
+
+
+def check_output_format(output_format):
+    '''
+    Raise an exception if the output format is unknown or its writer is not
+    installed, so that a run does not fail after the extraction.
+    '''
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception('Unknown output format "{}". Supported formats are: {}'.format(
+            output_format, ', '.join(OUTPUT_FORMATS)))
+    if output_format != 'csv':
+        try:
+            import pyarrow  # pylint: disable=unused-import
+        except ImportError:
+            raise Exception(
+                'Output format "{}" requires pyarrow. Please, install it or '
+                'use the csv format.'.format(output_format))
+
+
+def write_results(store, colsn, path, output_format='csv', ids=None):
+    '''
+    Write the rows of a checkpoint store to the output file, one chunk at a
+    time. CSV keeps the float64 text output. Parquet and Feather files are
+    written with pyarrow, with typed columns (categorical id, integer slice and
+    float32 features) and compression.
+    Params:
+        store: CheckpointStore with the extracted rows
+        colsn: output columns (id, slice, bin_width, normalize and features)
+        path: output file
+        output_format: one of OUTPUT_FORMATS
+        ids: all the values of the id column, so that every chunk shares the
+            same categories
+    '''
+    if output_format == 'csv':
+        for k, df in enumerate(result_chunks(store, colsn)):
+            df.to_csv(path, index=True, header=k == 0, mode='w' if k == 0 else 'a')
+        return path
+
+    import pandas as pd
+
+    check_output_format(output_format)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    categories = sorted(set(ids)) if ids is not None else None
+    writer = None
+    for df in result_chunks(store, colsn):
+        df[colsn[0]] = pd.Categorical(df[colsn[0]], categories=categories)
+        df[colsn[1]] = df[colsn[1]].astype(np.int32)
+        df[colsn[4:]] = df[colsn[4:]].astype(np.float32)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            if output_format == 'parquet':
+                writer = pq.ParquetWriter(path, table.schema, compression=OUTPUT_COMPRESSION)
+            else:
+                # Feather (v2) is the Arrow IPC file format
+                writer = pa.ipc.new_file(
+                    path, table.schema,
+                    options=pa.ipc.IpcWriteOptions(compression=OUTPUT_COMPRESSION))
+        writer.write_table(table)
+    writer.close()
+
+    return path
+
+
+def feature_cache_spec(feature_cache=True, feature_cache_size=None):
+    '''
+    (path, size cap in bytes) of the persistent feature cache, as expected by
+    extract_image, or None if it is disabled.
+    '''
+    if not feature_cache:
+        return None
+    if feature_cache_size is None:
+        feature_cache_size = fc.DEFAULT_FEATURE_CACHE_SIZE
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return (os.path.join(CACHE_DIR, 'features.db'), int(feature_cache_size * 2**20))
+
+
+def prepare_job(
+    images, masks, slices_of_interest, bin_width=25, normalize=False,
+    feature_classes=None, features=None):
+    '''
+    Settings, labels, columns and frames of an extraction, from the image
+    headers and the mask ROI sidecars. The job is a plain dict, so it can be
+    shipped to other processes or nodes.
+    Params:
+        as in extract.
+    '''
+    settings = sweep_settings(bin_width, normalize)
+    selection = feature_selection(feature_classes, features)
+
+    # Labels found in any of the masks, listed from their sidecars. Masks
+    # without some of them get zeros in their columns.
+    labels = sorted(set().union(*(mask_index(m) for m in masks)))
+
+    assert len(images) == len(masks), \
+        '''Found different number of images versus masks: {} vs.
+        {}'''.format(len(images), len(masks))
+    print('Found images and masks such as', images[0], masks[0])
+
+    nii = nib.load(images[0])
+    if len(nii.shape) not in (3, 4):
+        raise Exception('''Image shape is {}. Supported shapes are in 3D or
+                        4D formats'''.format(nii.shape))
+
+    # The columns are those of the extractors used for the extraction
+    aux = feature_schema(get_extractor(PARAMS_FILE, *settings[0], selection=selection))
+    cols = []
     for lb in labels:
-        extractor = featureextractor.RadiomicsFeatureExtractor(params)
-        extractor.settings['binWidth'] = bin_width
-        extractor.settings['normalize'] = normalize
+        cols.extend(['lb{}'.format(int(lb)) + s for s in aux])
+
+    return {
+        'settings': settings,
+        'params': PARAMS_FILE,
+        'selection': selection,
+        'labels': labels,
+        'cols': cols,
+        'colsn': ['id', 'slice', 'bin_width', 'normalize'] + cols,
+        'frames': select_frames(images, slices_of_interest),
+    }
+
+
+def image_costs(job, images, masks, indexes=None):
+    '''
+    Estimated seconds of extracting a frame of each image of a job (or of the
+    images with the given indexes), with the cost model of previous runs.
+    '''
+    if indexes is None:
+        indexes = range(len(images))
+    model = cm.CostModel.load(COST_MODEL_FILE)
+    extractors = [get_extractor(job['params'], bw, norm, selection=job['selection'])
+                  for bw, norm in job['settings']]
+    return {
+        i: sum(frame_cost(model, extractors, mask_index(masks[i]), job['labels'],
+                          image_range(images[i])).values())
+        for i in indexes
+    }, model.runs
+
+
+def split_job(job, images, masks, n_parts):
+    '''
+    Split the images of a job in at most n_parts groups of similar estimated
+    cost (longest first, each image to the least loaded group).
+    Returns the lists of image indexes of the groups.
+    '''
+    costs, _ = image_costs(job, images, masks)
+    n_parts = max(1, min(int(n_parts), len(images)))
+    groups = [[] for _ in range(n_parts)]
+    loads = [0.] * n_parts
+    for i in sorted(costs, key=lambda i: -costs[i] * len(job['frames'][i])):
+        k = loads.index(min(loads))
+        groups[k].append(i)
+        loads[k] += costs[i] * len(job['frames'][i])
+    return [sorted(g) for g in groups if g]
+
+
+def add_stats(totals, counts):
+    '''
+    Add up the statistics of parts of an extraction: volume and feature cache
+    [hits, misses], and seconds and work units per feature class.
+    '''
+    if totals is None:
+        totals = {'volume_cache': [0, 0], 'feature_cache': [0, 0],
+                  'class_seconds': {}, 'class_work': {}}
+    if counts is None:
+        return totals
+    for key in ('volume_cache', 'feature_cache'):
+        totals[key] = [a + b for a, b in zip(totals[key], counts[key])]
+    for key in ('class_seconds', 'class_work'):
+        merged = collections.Counter(totals[key])
+        merged.update(counts[key])
+        totals[key] = dict(merged)
+    return totals
+
+
+def extract_frames(checkpoint, job, images, masks, indexes, workers=None, loading=(),
+                   cache=None):
+    '''
+    Extract the frames of the images with the given indexes into a checkpoint
+    store, serially or with a pool of worker processes.
+    Returns the statistics of the extraction (see add_stats).
+    Params:
+        checkpoint: checkpoint file, with the columns of the job already set
+        job: as returned by prepare_job
+        images, masks: all the image and mask filenames of the job
+        indexes: indexes of the images to extract
+        workers: number of processes (see extract)
+        loading: options of the volumes (see utils.volume_cache.Loading)
+        cache: (path, size cap in bytes) of the feature cache, or None
+    '''
+    frames = job['frames']
+    labels, settings = job['labels'], job['settings']
+    params, selection, cols = job['params'], job['selection'], job['cols']
+    indexes = list(indexes)
+    n_items = sum(len(frames[i]) for i in indexes)
+    if workers is None:
+        workers = available_workers()
+    workers = max(1, min(int(workers), n_items))
+    print('Extracting {} work items ({} setting(s) each) with {} worker(s)'.format(
+        n_items, len(settings), workers))
+
+    costs, runs = image_costs(job, images, masks, indexes)
+    print('Estimated extraction time: {:.1f} s (cost model learned from {} run(s))'.format(
+        sum(costs[i] * len(frames[i]) for i in indexes) / workers, runs))
+
+    if workers == 1:
+        counts = [
+            extract_image(
+                checkpoint, i, frames[i], cols, images[i], masks[i],
+                labels, settings, params, cache, selection, loading
+            )
+            for i in indexes
+        ]
+    else:
+        # Frames of the same image are grouped in chunks, so that masks are
+        # decoded once per chunk while there is still work for every worker.
+        # Chunks are dispatched longest first (by their estimated cost), so
+        # that the run does not end waiting for a single expensive chunk.
+        # Every frame is committed to the checkpoint, so results are assembled
+        # in deterministic order below regardless of completion order.
+        chunk = max(1, -(-n_items // (workers * CHUNKS_PER_WORKER)))
+        chunks = sorted((
+            (costs[i] * len(frames[i][k:k+chunk]), i, frames[i][k:k+chunk])
+            for i in indexes
+            for k in range(0, len(frames[i]), chunk)
+        ), key=lambda c: -c[0])
+        pool = worker_pool(workers, vc.Loading(*loading).cache_size)
+        broken = False
         try:
-            result = extractor.execute(slc, mk, label=int(lb))
-            for key, val in six.iteritems(result):
-                if key[:9] != 'original_':
-                    continue
-                aux[re.sub(r'original', 'lb{}'.format(int(lb)), key)] = val
-        except ValueError as err:
-            print(' extraction failed for this label: {}. Error:'.format(lb))
-            print(err)
-            continue
+            futures = [
+                pool.submit(
+                    extract_image, checkpoint, i, chunk_frames, cols,
+                    images[i], masks[i], labels, settings, params, cache, selection,
+                    loading)
+                for _, i, chunk_frames in chunks
+            ]
+            counts = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker died: do not keep its pool
+            broken = True
+            raise
+        finally:
+            release_worker_pool(pool, broken)
+
+    return add_stats(None, {
+        'volume_cache': [sum(c[0] for c in counts), sum(c[1] for c in counts)],
+        'feature_cache': [sum(c[2] for c in counts), sum(c[3] for c in counts)],
+        'class_seconds': dict(sum((c[4] for c in counts), collections.Counter())),
+        'class_work': dict(sum((c[5] for c in counts), collections.Counter())),
+    })
+
 
-    aux.to_csv(os.path.join(tmppath, 'tmp_{0:04d}_{1:03d}.csv'.format(i, j)), header=True)
-    time_end = time.time()
+def report_stats(totals, cache_enabled=True):
+    '''
+    Print the statistics of an extraction, learn the cost model from them and
+    return them as reported in the output metadata.
+    '''
+    totals = add_stats(None, totals)
+    hits, misses = totals['volume_cache']
+    print('Volume cache: {} hits, {} misses'.format(hits, misses))
+    cache_hits, cache_misses = totals['feature_cache']
+    if cache_enabled:
+        print('Feature cache: {} hits, {} misses'.format(cache_hits, cache_misses))
+    timings = collections.Counter(totals['class_seconds'])
+    total = sum(timings.values())
+    print('Time per feature class:')
+    for class_name, seconds in timings.most_common():
+        print(' - {0:<10} {1:8.2f} s ({2:.0%})'.format(
+            class_name, seconds, seconds / total if total > 0 else 0))
+    model = cm.CostModel.load(COST_MODEL_FILE)
+    model.learn(timings, totals['class_work'])
+    model.save(COST_MODEL_FILE)
 
-    print('Slice {0:03d} - Time {1:.2f} s'.format(j, time_end - time_start))
+    return {
+        'volume_cache': {'hits': hits, 'misses': misses},
+        'class_seconds': {c: round(t, 3) for c, t in timings.most_common()},
+        'feature_cache': {
+            'enabled': cache_enabled,
+            'hits': cache_hits,
+            'misses': cache_misses,
+            'hit_rate': cache_hits / float(max(1, cache_hits + cache_misses))
+        }
+    }
 
 
 def extract(
     images, masks, label_names, slices_of_interest,
-    output_path, bin_width=25, normalize=False):
+    output_path, bin_width=25, normalize=False, workers=None, cache_size=None,
+    resume=False, output_format='csv', dtype=None, geometry=True,
+    scratch_dir=None, scratch_size=None, feature_cache=True,
+    feature_cache_size=None, feature_classes=None, features=None, stats=None):
     '''
     Extract radiomics features from a set of images
     Params:
@@ -69,104 +1035,257 @@ def extract(
         slices_of_interest: list of tuples with slices of interest for feature extraction
             (e.g., [(0, 20), ...])
         output_path: path where final csv will be saved
-        bin_width: width of bins used for the binarization of intensity values
+        bin_width: width of bins used for the binarization of intensity values.
+            A list of widths sweeps over all of them.
         normalize: whether or not to normalize the images (Z-score -- N(0,1)).
+            A list of flags sweeps over all of them.
+        workers: number of processes used to extract the (image, frame) work
+            items. Default is all available cores; 1 runs serially.
+        cache_size: memory budget (MB) of the decoded volume cache of each
+            process.
+        resume: continue an interrupted run from the checkpoint found in
+            output_path, skipping the work items already extracted.
+        output_format: format of the results file, one of 'csv', 'parquet' or
+            'feather'.
+        dtype: data type of the image voxels used for the extraction (e.g.,
+            'float32'). Default keeps the data type stored on disk.
+        geometry: use the spacing, origin and direction of the NIfTI affine.
+            Otherwise volumes have unit spacing, as in older versions.
+        scratch_dir: directory where gzipped inputs are decompressed once, so
+            that their frames are memory-mapped. Default reads them in place.
+        scratch_size: size cap (MB) of scratch_dir.
+        feature_cache: reuse the features extracted by previous runs for the
+            same frame, mask, label and settings, stored in CACHE_DIR.
+        feature_cache_size: size cap (MB) of the feature cache.
+        feature_classes: feature classes to extract (e.g., ['firstorder',
+            'glcm']). Default extracts the classes enabled in Params.yaml.
+        features: individual features to extract, prefixed by their class
+            (e.g., ['glszm_ZoneEntropy']).
+        stats: dict filled with the hits and misses of the volume and feature
+            caches, and the seconds spent on each feature class.
     '''
     # ------------------
     # 1) Load settings for feature extractor and prepare variables
     # ------------------
-    wd = os.path.realpath(os.path.dirname(__file__))
-    params = os.path.join(wd, 'Params.yaml')
-    extractor = featureextractor.RadiomicsFeatureExtractor(params)
-    extractor.enableAllFeatures()
-    extractor.settings['binWidth'] = bin_width
-    extractor.settings['normalize'] = normalize
+    check_output_format(output_format)
+    loading = vc.Loading(cache_size, dtype, geometry, scratch_dir, scratch_size)
+    cache = feature_cache_spec(feature_cache, feature_cache_size)
 
-    # Temporary path to save features during the execution, in case the process
-    # breaks, so it can be restarted.
-    tmppath = os.path.join(output_path, 'tmp')
-    try:
-        # This folder should not exist, since the runXXX folder is always new.
-        os.makedirs(tmppath)
-    except FileExistsError:
+    # Checkpoint to save features during the execution, in case the process
+    # breaks, so it can be restarted. The job is extracted as a single part
+    # (see extract_partial and merge_partials).
+    checkpoint = os.path.join(output_path, 'checkpoint.db')
+    if os.path.exists(checkpoint) and not resume:
+        # This file should not exist, since the runXXX folder is always new.
         print('''
-        ERROR: Trying to create folder "{}" but it was not possible. Check that
-        the runXXX folder is a new one.'''.format(tmppath))
+        ERROR: Found checkpoint "{}" of a previous run. Check that the runXXX
+        folder is a new one, or resume the run.'''.format(checkpoint))
         return False
-
-    # Get available labels in first mask (and consider them as the labels to
-    # extract for the rest)
-    labels = np.unique(nib.load(masks[0]).get_fdata()).astype(int)
-    labels = labels[labels>0]
-
-    assert len(images) == len(masks), \
-        '''Found different number of images versus masks: {} vs.
-        {}'''.format(len(images), len(masks))
-    print('Found images and masks such as', images[0], masks[0])
+    os.makedirs(output_path, exist_ok=True)
 
     # ------------------
-    # 2) Take a sample image and set column names for the radiomics dataframe
+    # 2) Set column names for the radiomics dataframe
     # ------------------
-    nii = nib.load(images[0])
-    if len(nii.shape) == 4:
-        auxim = nii.slicer[...,0].get_fdata()
-        sample_image = sitk.GetImageFromArray(auxim)
-    elif len(nii.shape) == 3:
-        auxim = nii.get_fdata()
-        sample_image = sitk.GetImageFromArray(auxim)
-    else:
-        raise Exception('''Image shape is {}. Supported shapes are in 3D or
-                        4D formats'''.format(images[0].shape))
-
-    mk = nib.load(masks[0]).get_fdata()
-    mk = sitk.GetImageFromArray(mk)
-    result = extractor.execute(sample_image, mk, label=int(labels[0]))
-    aux = []
-    for key, _ in six.iteritems(result):
-        if key[:9] != 'original_':
-            continue
-        aux.append(re.sub(r'original', '', key))
-    cols = []
-    for lb in labels:
-        cols.extend(['lb{}'.format(int(lb)) + s for s in aux])
+    job = prepare_job(images, masks, slices_of_interest, bin_width, normalize,
+                      feature_classes, features)
 
     # ------------------
     # 3) Extract radiomics features for all images found
     # ------------------
-    colsn = ['id', 'slice', 'bin_width', 'normalize'] + cols
-    for i, image in enumerate(images):
-        nii = nib.load(image)
-        slc_num = 1 if len(nii.shape) == 3 else nii.shape[-1]
-        # Set slices of interest. Default is all slices.
-        soi = slices_of_interest[i]
-        slc_selected = soi if soi is not None else range(slc_num)
-
-        # Iterate over each temporal slice in case it is available
-        for j in range(slc_num):
-            if slc_num > 1:
-                # Skip if slice is not among selected slices
-                if j not in slc_selected: continue
-                auxim = nii.slicer[...,j].get_fdata()
-                slc = sitk.GetImageFromArray(auxim)
-            else:
-                auxim = nii.get_fdata()
-                slc = sitk.GetImageFromArray(auxim)
-
-            extract_features(
-                tmppath, i, j, colsn, image, slc, masks[i], 
-                labels, bin_width, normalize, params
-            )
+    extract_partial(
+        checkpoint, job, images, masks, list(range(len(images))), workers, loading,
+        cache, resume)
 
     # ------------------
-    # 4) Save results to a pandas DataFrame
+    # 4) Save results, one chunk of rows at a time
     # ------------------
-    df = pd.DataFrame(data=np.zeros((len(images), len(colsn))), columns=colsn)
-    for i,f in enumerate(sorted(os.listdir(tmppath))):
-        arr = pd.read_csv(os.path.join(tmppath, f), index_col=0)
-        df.loc[i, arr.index.values] = arr.values.flatten()
+    file_path = os.path.join(
+        output_path, 'radiomic_features.' + OUTPUT_FORMATS[output_format][0])
+    summary = merge_partials(
+        file_path, job, images, [checkpoint], output_format, cache is not None)
+    if stats is not None:
+        stats.update(summary)
+    os.remove(checkpoint)
+
+    return file_path
+
+
+def extract_partial(
+    partial, job, images, masks, indexes, workers=None, loading=(),
+    cache=None, resume=False):
+    '''
+    Extract the frames of some of the images of a job into a partial
+    checkpoint, to be merged with merge_partials. The statistics of the
+    extraction are stored in the partial checkpoint too. This is the unit of
+    work distributed as a task by RAD_RUNNER.
+    Params:
+        partial: checkpoint file of this part
+        job: as returned by prepare_job
+        images, masks: all the image and mask filenames of the job
+        indexes: indexes of the images of this part
+        workers: number of processes of this part (see extract)
+        loading: options of the volumes (see utils.volume_cache.Loading)
+        cache: (path, size cap in bytes) of the feature cache, or None
+        resume: continue from an existing partial checkpoint
+    Returns the statistics of this part.
+    '''
+    if os.path.exists(partial) and not resume:
+        raise Exception('Found partial checkpoint "{}" of a previous run. Check that '
+                        'the runXXX folder is a new one, or resume the run.'.format(partial))
+    vc.configure(vc.Loading(*loading).cache_size)
+    store = CheckpointStore(partial)
+    store.set_columns(job['cols'])
+    store.set_settings(job['settings'])
+    if resume:
+        print('Resuming run: {} rows already extracted'.format(len(store)))
+    totals = extract_frames(partial, job, images, masks, indexes, workers, loading, cache)
+    store.set_meta('stats', totals)
+    store.close()
+    return totals
+
+
+def merge_partials(
+    output_file, job, images, partials, output_format='csv', cache_enabled=True):
+    '''
+    Merge the partial checkpoints of a job, learn the cost model from their
+    statistics and write the results file. The partial checkpoints are left
+    for the caller to remove.
+    Params:
+        output_file: results file
+        job: as returned by prepare_job
+        images: all the image filenames of the job
+        partials: partial checkpoint files, as written by extract_partial
+        output_format: one of OUTPUT_FORMATS
+        cache_enabled: whether the feature cache was used
+    Returns the statistics of the run.
+    '''
+    # The merged checkpoint only lives until the results are written
+    fd, checkpoint = tempfile.mkstemp(prefix='radiomics_merge_', suffix='.db')
+    os.close(fd)
+    store = CheckpointStore(checkpoint)
+    store.set_columns(job['cols'])
+    totals = None
+    for partial in partials:
+        store.merge(partial)
+        part = CheckpointStore(partial)
+        totals = add_stats(totals, part.meta('stats'))
+        part.close()
+    summary = report_stats(totals, cache_enabled)
+
+    write_results(
+        store, job['colsn'], output_file, output_format,
+        ids=[os.path.basename(image) for image in images])
+    store.close()
+    os.remove(checkpoint)
+
+    return summary
+
+
+def available_memory():
+    '''
+    Memory available for new processes, in bytes (None if unknown).
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plan(
+    images, masks, slices_of_interest, bin_width=25, normalize=False,
+    workers=None, cache_size=None, dtype=None, feature_classes=None, features=None):
+    '''
+    Estimate the cost of an extraction without running it. Only the image
+    headers and the mask ROI sidecars are read (masks without a fresh sidecar
+    are indexed), and the cost model learned from previous runs is applied.
+    Returns a dict with the number of work items, the CPU seconds, the peak
+    memory of each worker and a suggested number of workers.
+    Params:
+        images, masks, slices_of_interest, bin_width, normalize, workers,
+        cache_size, dtype, feature_classes, features: as in extract.
+    '''
+    settings = sweep_settings(bin_width, normalize)
+    selection = feature_selection(feature_classes, features)
+    extractors = [get_extractor(PARAMS_FILE, bw, norm, selection=selection)
+                  for bw, norm in settings]
+    model = cm.CostModel.load(COST_MODEL_FILE)
+    if cache_size is None:
+        cache_size = vc.DEFAULT_CACHE_SIZE
+
+    rois = [mask_index(mask) for mask in masks]
+    labels = sorted(set().union(*rois))
+    frames = select_frames(images, slices_of_interest)
+    n_items = sum(len(f) for f in frames)
+
+    class_seconds = collections.Counter()
+    item_seconds = 0
+    peak_rss = 0
+    for i, image in enumerate(images):
+        header = nib.load(image).header
+        mask_header = nib.load(masks[i]).header
+        intensity_range = image_range(image)
+        cost = frame_cost(model, extractors, rois[i], labels, intensity_range)
+        for class_name, seconds in cost.items():
+            class_seconds[class_name] += seconds * len(frames[i])
+        # Mask-only classes, once per mask and label
+        for class_name in extracted_classes(extractors[0]):
+            if class_name in MASK_FEATURE_CLASSES:
+                class_seconds[class_name] += sum(
+                    model.cost(class_name, count, 1) for count, _ in rois[i].values())
+        item_seconds = max(item_seconds, sum(cost.values()))
+
+        # Decoded volumes kept in the cache of a worker: the frames of one
+        # image and its mask
+        itemsize = np.dtype(dtype).itemsize if dtype else header.get_data_dtype().itemsize
+        frame_voxels = int(np.prod(header.get_data_shape()[:3]))
+        mask_bytes = int(np.prod(mask_header.get_data_shape())) * \
+            mask_header.get_data_dtype().itemsize
+        volumes = min(cache_size * 2**20,
+                      frame_voxels * itemsize * len(frames[i]) + mask_bytes)
+        # pyradiomics works on float64 copies of the (cropped) ROI, and on
+        # texture matrices that grow with the number of grey levels
+        working = 0
+        for extractor in extractors:
+            levels = setting_levels(extractor, intensity_range)
+            for count, bbox in rois[i].values():
+                voxels = int(np.prod([
+                    b - a for a, b in roi_index.crop_box(
+                        bbox, header.get_data_shape()[:3],
+                        extractor.settings.get('padDistance', 5))
+                ])) if can_crop(extractor) else frame_voxels
+                grey = min(levels, count)
+                working = max(working, 6 * voxels * 8 + 13 * grey * (grey + count) * 8)
+        peak_rss = max(peak_rss, BASE_RSS + volumes + frame_voxels * itemsize + working)
 
-    csv_file_path = os.path.join(output_path, 'radiomic_features.csv')
-    df.to_csv(csv_file_path, index=True)
-    shutil.rmtree(tmppath)
+    cpu_seconds = sum(class_seconds.values())
+    cores = available_workers()
+    memory = available_memory()
+    suggested = max(1, min(cores, n_items))
+    if memory is not None:
+        suggested = max(1, min(suggested, memory // peak_rss)) if peak_rss > 0 else suggested
+    if workers is not None:
+        workers = max(1, min(int(workers), n_items))
+    wall_workers = workers or suggested
 
-    return csv_file_path
+    return {
+        'images': len(images),
+        'labels': [int(lb) for lb in labels],
+        'settings': [[bw, norm] for bw, norm in settings],
+        'work_items': n_items,
+        'cpu_seconds': round(cpu_seconds, 2),
+        'class_seconds': {c: round(t, 2) for c, t in class_seconds.most_common()},
+        'wall_seconds': round(max(cpu_seconds / wall_workers, item_seconds), 2),
+        'peak_rss_mb_per_worker': int(np.ceil(peak_rss / 2.**20)),
+        'suggested_workers': int(suggested),
+        'workers': workers,
+        'available_cores': cores,
+        'available_memory_mb': int(memory / 2**20) if memory is not None else None,
+        'cost_model_runs': model.runs
+    }
@@ -16,13 +16,16 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import os
 import sys
+import json
 import argparse
+
 from basic_modules.workflow import Workflow
 from utils import logger
 
-from apps.jsonapp import JSONApp
-from tool.VRE_RAD import RAD_RUNNER
+# The App and the Tool (which imports the scientific stack) are imported when
+# they are launched, so that parsing and checking the arguments is fast.
 
 
 class process_WF_RUNNER(Workflow):
@@ -44,6 +47,7 @@ class process_WF_RUNNER(Workflow):
         if configuration is None:
             configuration = {}
 
+        self.configuration = dict(self.configuration)
         self.configuration.update(configuration)
 
     def run(self, input_files, metadata, output_files):
@@ -61,6 +65,7 @@ class process_WF_RUNNER(Workflow):
         """
         try:
             logger.info("Initialise the CWL Test Tool")
+            from tool.VRE_RAD import RAD_RUNNER
             tt_handle = RAD_RUNNER(self.configuration)
             tt_files, tt_meta = tt_handle.run(input_files, metadata, output_files)
             return tt_files, tt_meta
@@ -71,7 +76,7 @@ class process_WF_RUNNER(Workflow):
             raise Exception(errstr)
 
 
-def main_json(config, in_metadata, out_metadata):
+def main_json(config, in_metadata, out_metadata, arguments=None):
     """
     Main function.
 
@@ -81,17 +86,21 @@ def main_json(config, in_metadata, out_metadata):
     :param config:
     :param in_metadata:
     :param out_metadata:
+    :param arguments: tool arguments overriding those in config.json
     :type config:
     :type in_metadata:
     :type out_metadata:
+    :type arguments: dict
     :return: If result is True, execution finished successfully. False,
         otherwise.
     :rtype: bool
     """
     try:
         logger.info("1. Instantiate and launch the App")
+        from apps.jsonapp import JSONApp
         app = JSONApp()
-        result = app.launch(process_WF_RUNNER, config, in_metadata, out_metadata)  # launch the app
+        result = app.launch(process_WF_RUNNER, config, in_metadata, out_metadata,
+                            arguments)  # launch the app
         logger.info("2. App successfully launched; see " + out_metadata)
         return result
 
@@ -101,18 +110,187 @@ def main_json(config, in_metadata, out_metadata):
         raise Exception(errstr)
 
 
+def read_manifest(manifest):
+    """
+    Jobs of a batch manifest.
+
+    The manifest is a JSON list with an entry per job: either a
+    [config, in_metadata, out_metadata] triple of paths, or an object with
+    those keys and, optionally, "arguments" overriding those in its
+    config.json. Relative paths are relative to the folder of the manifest.
+
+    :param manifest: path of the manifest
+    :type manifest: str
+    :return: (config, in_metadata, out_metadata, arguments) of each job.
+    :rtype: list
+    """
+    with open(manifest) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise Exception("Manifest {} must be a list of jobs".format(manifest))
+
+    folder = os.path.dirname(os.path.abspath(manifest))
+    jobs = []
+    for k, entry in enumerate(entries):
+        arguments = {}
+        if isinstance(entry, dict):
+            arguments = entry.get('arguments', {})
+            entry = [entry.get(key) for key in ('config', 'in_metadata', 'out_metadata')]
+        if not isinstance(entry, (list, tuple)) or len(entry) != 3 or not all(entry):
+            raise Exception("Job {} of manifest {} must give its config, in_metadata and "
+                            "out_metadata".format(k, manifest))
+        jobs.append(tuple(os.path.join(folder, path) for path in entry) + (arguments,))
+    return jobs
+
+
+def run_batch_job(job, arguments=None, local=False):
+    """
+    Launch a job of a batch, returning whether it finished successfully. The
+    working directory, changed by the tool, is restored afterwards.
+
+    :param job: (config, in_metadata, out_metadata, arguments), as returned
+        by read_manifest
+    :param arguments: tool arguments overriding those of the job
+    :param local: run the tasks with the local runtime (see --local), also
+        when called in a worker process of the batch
+    :type job: tuple
+    :type arguments: dict
+    :type local: bool
+    :rtype: bool
+    """
+    config, in_metadata, out_metadata, job_arguments = job
+    job_arguments = dict(job_arguments)
+    job_arguments.update(arguments or {})
+    if local:
+        sys._run_from_cmdl = True  # pylint: disable=protected-access
+    cwd = os.getcwd()
+    try:
+        return bool(main_json(config, in_metadata, out_metadata, job_arguments))
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error("Job {} failed: {}", out_metadata, error)
+        return False
+    finally:
+        os.chdir(cwd)
+
+
+def main_batch(manifest, arguments=None, concurrency=1):
+    """
+    Batch function.
+
+    This function launches the jobs of a manifest (see read_manifest) in this
+    process, so that they share the imports and warm caches. Jobs run at the
+    same time (concurrency > 1) are launched in as many worker processes,
+    each running its jobs one after the other, as a job changes the working
+    directory and other state of its process. A job failing does not stop the
+    others, and the results JSON of each job is written as soon as it
+    finishes.
+
+    :param manifest: path of the manifest
+    :param arguments: tool arguments overriding those of every job
+    :param concurrency: number of jobs run at the same time
+    :type manifest: str
+    :type arguments: dict
+    :type concurrency: int
+    :return: Whether each job finished successfully, by out_metadata path.
+    :rtype: dict
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    jobs = read_manifest(manifest)
+    local = hasattr(sys, '_run_from_cmdl')
+    logger.info("Running {} job(s) of manifest {}", len(jobs), manifest)
+
+    def report(k, out_metadata, ok):
+        results[out_metadata] = ok
+        logger.progress("Batch job {} {}".format(
+            out_metadata, "finished" if ok else "FAILED"), task_id=k, total=len(jobs))
+
+    results = {}
+    if concurrency <= 1:
+        for k, job in enumerate(jobs, start=1):
+            report(k, job[2], run_batch_job(job, arguments, local))
+    else:
+        with ProcessPoolExecutor(max_workers=int(concurrency)) as pool:
+            futures = {pool.submit(run_batch_job, job, arguments, local): job[2]
+                       for job in jobs}
+            for k, future in enumerate(as_completed(futures), start=1):
+                out_metadata = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.error("Job {} failed: {}", out_metadata, error)
+                    ok = False
+                report(k, out_metadata, ok)
+
+    failed = [out_metadata for out_metadata, ok in results.items() if not ok]
+    logger.info("Batch finished: {} job(s) succeeded, {} failed",
+                len(results) - len(failed), len(failed))
+    return results
+
+
+def main_serve(port=None, socket_path=None, workdir=None):
+    """
+    Service function.
+
+    This function runs the extraction service (see apps.service) until it is
+    interrupted: jobs submitted on a Unix socket, or on localhost, are
+    launched with main_json in this process, which keeps the scientific stack,
+    extractors, worker processes and volume caches warm.
+
+    :param port: localhost port of the service. Requests must then give the
+        token written to the workdir.
+    :param socket_path: Unix socket of the service, if no port is given.
+        Default, service.sock in the workdir.
+    :param workdir: folder of the files of the submitted jobs
+    :type port: int
+    :type socket_path: str
+    :type workdir: str
+    """
+    from apps.service import ExtractionService
+
+    service = ExtractionService(main_json, workdir)
+    logger.info("Warming up the extraction service")
+    service.warm_up()
+    service.serve(port, socket_path)
+
+
 if __name__ == "__main__":
 
     # Set up the command line parameters
     parser = argparse.ArgumentParser(description="VRE CWL workflow runner")
-    parser.add_argument("--config", help="Configuration file", required=True)
-    parser.add_argument("--in_metadata", help="Location of input metadata file", required=True)
-    parser.add_argument("--out_metadata", help="Location of output metadata file", required=True)
+    parser.add_argument("--config", help="Configuration file")
+    parser.add_argument("--in_metadata", help="Location of input metadata file")
+    parser.add_argument("--out_metadata", help="Location of output metadata file")
+    parser.add_argument("--batch", help="Manifest of (config, in_metadata, out_metadata) jobs "
+                        "to run in this process, instead of a single job")
+    parser.add_argument("--batch_workers", help="Number of batch jobs run at the same time",
+                        type=int, default=1)
+    parser.add_argument("--serve", help="Run the extraction service, taking jobs on a Unix "
+                        "socket (--socket) or a localhost port (--port)",
+                        action="store_const", const=True, default=False)
+    parser.add_argument("--socket", help="Unix socket of the extraction service. Default, "
+                        "service.sock in its workdir")
+    parser.add_argument("--port", help="Localhost port of the extraction service, instead of "
+                        "a Unix socket. Requests must give the token written to its workdir",
+                        type=int)
+    parser.add_argument("--serve_workdir", help="Folder of the files of the service jobs. "
+                        "Default, a temporary folder")
     parser.add_argument("--log_file", help="Location of the log file", required=False)
     parser.add_argument("--local", action="store_const", const=True, default=False)
+    parser.add_argument("--resume", help="Resume an interrupted run from its checkpoint",
+                        action="store_const", const=True, default=False)
+    parser.add_argument("--plan", help="Only estimate the runtime and memory of the job, "
+                        "from the headers of its inputs",
+                        action="store_const", const=True, default=False)
 
     # Get the matching parameters from the command line
     args = parser.parse_args()
+    if not (args.batch or args.serve) and \
+            not (args.config and args.in_metadata and args.out_metadata):
+        parser.error("--config, --in_metadata and --out_metadata are required, unless "
+                     "--batch or --serve is given")
+    if args.socket and args.port is not None:
+        parser.error("--socket and --port are exclusive")
 
     CONFIG = args.config
     IN_METADATA = args.in_metadata
@@ -125,4 +303,18 @@ if __name__ == "__main__":
     if LOCAL:
         sys._run_from_cmdl = True  # pylint: disable=protected-access
 
-    RESULTS = main_json(CONFIG, IN_METADATA, OUT_METADATA)
+    ARGUMENTS = {}
+    if args.resume:
+        ARGUMENTS['resume'] = True
+    if args.plan:
+        ARGUMENTS['plan'] = True
+
+    if args.serve:
+        main_serve(args.port, args.socket, args.serve_workdir)
+        sys.exit(0)
+
+    if args.batch:
+        RESULTS = main_batch(args.batch, ARGUMENTS, args.batch_workers)
+        sys.exit(0 if all(RESULTS.values()) else 1)
+
+    RESULTS = main_json(CONFIG, IN_METADATA, OUT_METADATA, ARGUMENTS)
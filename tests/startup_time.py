@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+"""
+Startup time benchmark of the CLI.
+
+Imports main.py with ``python -X importtime`` and checks that the scientific
+stack is not imported before the extraction needs it, and that the import
+time of main.py is within budget. The wall time of ``main.py --help`` is
+reported too. Exits with status 1 if a check fails, e.g.:
+
+    python tests/startup_time.py --budget-ms 100
+"""  # pylint: disable=pointless-string-statement
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that must only be imported by the extraction path
+HEAVY_MODULES = ('numpy', 'pandas', 'scipy', 'nibabel', 'SimpleITK', 'radiomics', 'pyarrow')
+DEFAULT_BUDGET_MS = 100
+
+
+def import_times(module):
+    """
+    Self and cumulative import time (us) of every module imported by a fresh
+    interpreter importing module from the repository root.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def help_time(repeat):
+    """
+    Median wall time (ms) of main.py --help.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'main.py'), '--help'],
+            cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        runs.append((time.time() - start) * 1000)
+    return sorted(runs)[len(runs) // 2]
+
+
+def main(budget_ms=DEFAULT_BUDGET_MS, repeat=5, top=10):
+    """
+    Run the benchmark. Returns True if the CLI starts within budget.
+    """
+    ok = True
+    best = None
+    for _ in range(repeat):
+        times = import_times('main')
+        total = [cumulative for name, _, cumulative in times if name.strip() == 'main'][-1]
+        if best is None or total < best[0]:
+            best = (total, times)
+    total, times = best
+    # Keep the modules imported by main, not those of the interpreter startup
+    start = max(
+        [k + 1 for k, (name, _, _) in enumerate(times[:-1])
+         if len(name) - len(name.lstrip()) == 1] or [0])
+    times = times[start:]
+
+    heavy = sorted({
+        name.strip().split('.')[0] for name, _, _ in times
+        if name.strip().split('.')[0] in HEAVY_MODULES
+    })
+    if heavy:
+        print('FAIL: importing main imports {}'.format(', '.join(heavy)))
+        ok = False
+
+    print('Import time of main: {:.1f} ms (budget {} ms)'.format(total / 1000., budget_ms))
+    if total / 1000. > budget_ms:
+        print('FAIL: import time of main is over budget')
+        ok = False
+    print('Slowest imports:')
+    for name, self_us, _ in sorted(times, key=lambda t: -t[1])[:top]:
+        print(' - {0:<40} {1:8.1f} ms'.format(name.strip(), self_us / 1000.))
+    print('Wall time of main.py --help: {:.1f} ms'.format(help_time(repeat)))
+    return ok
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Startup time benchmark of the CLI")
+    PARSER.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="Maximum import time of main.py (ms)")
+    PARSER.add_argument("--repeat", type=int, default=5,
+                        help="Number of runs (the best one is checked)")
+    ARGS = PARSER.parse_args()
+
+    sys.exit(0 if main(ARGS.budget_ms, ARGS.repeat) else 1)
@@ -17,13 +17,30 @@
    limitations under the License.
 """
 import os
+import sys
+import json
+
+try:
+    if hasattr(sys, '_run_from_cmdl') is True:
+        raise ImportError
+    from pycompss.api.parameter import FILE_IN, FILE_OUT, FILE_INOUT
+    from pycompss.api.task import task
+    from pycompss.api.api import compss_wait_on, compss_delete_file
+except ImportError:
+    print("[Warning] Cannot import \"pycompss\" API packages.")
+    print("          Using mock decorators.")
+
+    from utils.dummy_pycompss import FILE_IN, FILE_OUT, FILE_INOUT
+    from utils.dummy_pycompss import task
+    from utils.dummy_pycompss import compss_wait_on, compss_delete_file
 
 from basic_modules.metadata import Metadata
 from utils import logger
 from basic_modules.tool import Tool
 
-from extract_radiomics import extract
-import radiomics 
+# extract_radiomics, the preflight checks and radiomics import the scientific
+# stack (pandas, nibabel, SimpleITK, pyradiomics), so they are imported by
+# the methods using them rather than when the tool is loaded.
 
 
 class RAD_RUNNER(Tool):
@@ -51,7 +68,7 @@ class RAD_RUNNER(Tool):
         # Arrays are serialized
         for k, v in self.configuration.items():
             if isinstance(v, list):
-                self.configuration[k] = ' '.join(v)
+                self.configuration[k] = ' '.join(str(el) for el in v)
 
         self.populable_outputs = []
 
@@ -71,6 +88,12 @@ class RAD_RUNNER(Tool):
             matching metadata for the returned files
         (output_metadata). :rtype: dict, dict
         """
+        from extract_radiomics import (
+            prepare_job, check_output_format, feature_cache_spec, available_workers,
+            OUTPUT_FORMATS)
+        from utils.preflight import preflight
+        import radiomics
+
         try:
             # Set and check execution directory. If not exists the directory will be created.
             execution_path = os.path.abspath(self.configuration.get('execution', '.'))
@@ -84,13 +107,71 @@ class RAD_RUNNER(Tool):
 
             logger.debug("Init execution of the Segmentation")
 
-            # Extract radiomics
-            output_filepath = extract(
+            # Validate all the inputs from their headers before any voxel
+            # work, reporting every problem found
+            problems = preflight(
+                input_files['images'], input_files['masks'],
+                input_metadata['slicing_points'],
+                geometry=input_metadata.get('geometry', True))
+            if problems:
+                for problem in problems:
+                    logger.error(problem)
+                raise Exception('Found {} problem(s) in the inputs'.format(len(problems)))
+
+            # Extract radiomics. Lists of bin widths and normalize flags are
+            # swept in a single run.
+            bin_width = input_metadata['bin_width']
+            normalize = input_metadata.get('normalize', [False])
+            if input_metadata.get('plan', False):
+                return self.plan(input_files, input_metadata)
+
+            # The images are split in groups of similar estimated cost, each
+            # extracted by a task into a partial checkpoint (using `workers`
+            # local processes), and a last task merges them into the results
+            # file. With PyCOMPSs, the tasks are spread across the nodes.
+            output_folder = input_metadata['output_folder']
+            output_format = input_metadata.get('output_format', 'csv')
+            check_output_format(output_format)
+            os.makedirs(output_folder, exist_ok=True)
+            job = prepare_job(
                 input_files['images'], input_files['masks'],
-                label_names=input_metadata['label_names'],
-                slices_of_interest=input_metadata['slicing_points'],
-                output_path=input_metadata['output_folder'],
-                bin_width=input_metadata['bin_width'], normalize=False)
+                input_metadata['slicing_points'], bin_width, normalize,
+                input_metadata.get('feature_classes'), input_metadata.get('features'))
+            groups = self.split(job, input_files, input_metadata)
+            loading = (
+                input_metadata.get('cache_size'), input_metadata.get('dtype'),
+                input_metadata.get('geometry', True), input_metadata.get('scratch_dir'),
+                input_metadata.get('scratch_size'))
+            cache = feature_cache_spec(
+                input_metadata.get('feature_cache', True),
+                input_metadata.get('feature_cache_size'))
+            # Unless given, the cores are shared by the tasks, which may run
+            # on the same node
+            workers = input_metadata.get('workers') or \
+                max(1, available_workers() // len(groups))
+
+            partials = []
+            for k, group in enumerate(groups):
+                partial = os.path.join(output_folder, 'partial_{:03d}.db'.format(k))
+                # Partial checkpoints of a resumed run are read by their task
+                extract_task = self.extract_task
+                if input_metadata.get('resume', False) and os.path.exists(partial):
+                    extract_task = self.resume_task
+                extract_task(
+                    partial, job, input_files['images'], input_files['masks'], group,
+                    workers, loading, cache)
+                partials.append(partial)
+
+            output_filepath = os.path.join(
+                output_folder, 'radiomic_features.' + OUTPUT_FORMATS[output_format][0])
+            extraction = self.merge_task(
+                output_filepath, job, input_files['images'], output_format,
+                cache is not None, *partials)
+            # The partial checkpoints are only removed once merged
+            extraction = compss_wait_on(extraction)
+            for partial in partials:
+                compss_delete_file(partial)
+            os.remove(os.path.join(output_folder, 'partials.json'))
 
             # Generate metadata for output files
             output_files = [{
@@ -101,15 +182,21 @@ class RAD_RUNNER(Tool):
             meta = Metadata()
             meta.file_path = output_filepath
             meta.data_type = 'machine_learning_features'
-            meta.file_type = 'CSV'
+            meta.file_type = OUTPUT_FORMATS[input_metadata.get('output_format', 'csv')][1]
             meta.meta_data = {
                 'sources': {
                     'images': input_files['images'],
                     'masks': input_files['masks']
                 },
-                'bin_width': input_metadata['bin_width'],
+                'bin_width': bin_width if len(bin_width) > 1 else bin_width[0],
                 'pyradiomics_version': radiomics.__version__,
-                'normalize': False
+                'normalize': normalize if len(normalize) > 1 else normalize[0],
+                'geometry': input_metadata.get('geometry', True),
+                'feature_classes': input_metadata.get('feature_classes'),
+                'features': input_metadata.get('features'),
+                # Cache hits and seconds per feature class, returned by the
+                # merge task
+                'extraction': extraction
             }
             out_meta = [meta]
 
@@ -122,3 +209,116 @@ class RAD_RUNNER(Tool):
             errstr = "VRE CWL RUNNER pipeline failed. See logs"
             logger.fatal(errstr)
             raise Exception(errstr)
+
+    def split(self, job, input_files, input_metadata):  # pylint: disable=no-self-use
+        """
+        Split the images of the job in `tasks` groups of similar estimated
+        cost. The groups are saved in the output folder, so that a resumed run
+        extracts the same groups into the same partial checkpoints.
+
+        :return: List of image indexes of each group.
+        :rtype: list
+        """
+        from extract_radiomics import split_job
+
+        groups_filepath = os.path.join(input_metadata['output_folder'], 'partials.json')
+        if os.path.exists(groups_filepath):
+            if not input_metadata.get('resume', False):
+                raise Exception('''Found partial checkpoints of a previous run in "{}".
+                    Check that the runXXX folder is a new one, or resume the
+                    run.'''.format(input_metadata['output_folder']))
+            with open(groups_filepath) as f:
+                return json.load(f)
+
+        groups = split_job(
+            job, input_files['images'], input_files['masks'],
+            input_metadata.get('tasks') or 1)
+        with open(groups_filepath, 'w') as f:
+            json.dump(groups, f)
+        logger.info("Extraction split in {} task(s)".format(len(groups)))
+        return groups
+
+    @task(partial=FILE_OUT, returns=1, isModifier=False)
+    def extract_task(  # pylint: disable=no-self-use,too-many-arguments
+            self, partial, job, images, masks, indexes, workers, loading, cache):
+        """
+        Extract the frames of a group of images into a partial checkpoint.
+
+        :return: Statistics of the extraction of the group.
+        :rtype: dict
+        """
+        from extract_radiomics import extract_partial
+
+        return extract_partial(
+            partial, job, images, masks, indexes, workers, loading, cache)
+
+    @task(partial=FILE_INOUT, returns=1, isModifier=False)
+    def resume_task(  # pylint: disable=no-self-use,too-many-arguments
+            self, partial, job, images, masks, indexes, workers, loading, cache):
+        """
+        Extract the frames of a group of images missing from the partial
+        checkpoint of an interrupted run.
+
+        :return: Statistics of the extraction of the group.
+        :rtype: dict
+        """
+        from extract_radiomics import extract_partial
+
+        return extract_partial(
+            partial, job, images, masks, indexes, workers, loading, cache, resume=True)
+
+    @task(output_file=FILE_OUT, varargsType=FILE_IN, returns=1, isModifier=False)
+    def merge_task(  # pylint: disable=no-self-use,too-many-arguments
+            self, output_file, job, images, output_format, cache_enabled, *partials):
+        """
+        Merge the partial checkpoints of the groups into the results file.
+
+        :return: Statistics of the whole extraction.
+        :rtype: dict
+        """
+        from extract_radiomics import merge_partials
+
+        return merge_partials(
+            output_file, job, images, list(partials), output_format, cache_enabled)
+
+    def plan(self, input_files, input_metadata):  # pylint: disable=no-self-use
+        """
+        Estimate the work items, CPU time, memory per worker and suggested
+        number of workers of the job from the headers of its inputs, and
+        write them as JSON in the output folder instead of running it.
+
+        :return: List with the estimate file, and its metadata.
+        :rtype: list, dict
+        """
+        from extract_radiomics import plan
+
+        estimate = plan(
+            input_files['images'], input_files['masks'],
+            slices_of_interest=input_metadata['slicing_points'],
+            bin_width=input_metadata['bin_width'],
+            normalize=input_metadata.get('normalize', [False]),
+            workers=input_metadata.get('workers'),
+            cache_size=input_metadata.get('cache_size'),
+            dtype=input_metadata.get('dtype'),
+            feature_classes=input_metadata.get('feature_classes'),
+            features=input_metadata.get('features'))
+
+        os.makedirs(input_metadata['output_folder'], exist_ok=True)
+        plan_filepath = os.path.join(input_metadata['output_folder'], 'radiomics_plan.json')
+        with open(plan_filepath, 'w') as f:
+            json.dump(estimate, f, indent=4)
+        logger.info("Estimated {} CPU seconds, {} MB per worker, {} worker(s)".format(
+            estimate['cpu_seconds'], estimate['peak_rss_mb_per_worker'],
+            estimate['suggested_workers']))
+
+        meta = Metadata()
+        meta.file_path = plan_filepath
+        meta.data_type = 'job_plan'
+        meta.file_type = 'JSON'
+        meta.meta_data = estimate
+
+        output_files = [{
+            'name': 'radiomics_plan',
+            'file_path': plan_filepath
+        }]
+        return output_files, {'output_files': [meta]}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import json
+import sqlite3
+
+import numpy as np
+
+"""
+Checkpoint store of the extraction.
+
+A single SQLite file holds one row per (image, frame) work item and
+(bin_width, normalize) setting, so that an interrupted run can be resumed by
+skipping the rows already stored. Every row is committed in its own
+transaction, hence a crash never leaves a partially written row behind. Several processes may write to the same store;
+SQLite serialises their commits.
+"""  # pylint: disable=pointless-string-statement
+
+
+class CheckpointStore(object):
+    """
+    Append-only store of extracted feature rows.
+    """
+
+    def __init__(self, path, timeout=600):
+        """
+        Open (and create, if needed) the store.
+
+
+        Parameters
+        ----------
+        path : str
+            SQLite file of the store
+        timeout : float
+            Seconds to wait for other processes holding the write lock.
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'image INTEGER, frame INTEGER, id TEXT, slice INTEGER, '
+                'bin_width REAL, normalize INTEGER, features BLOB, '
+                'PRIMARY KEY (image, frame, bin_width, normalize))')
+
+    def _set_or_check(self, key, value, description):
+        """
+        Record a value of the run, or check that it matches the one of the run
+        being resumed.
+        """
+        value = json.loads(json.dumps(value))
+        stored = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if stored is None:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+        elif json.loads(stored[0]) != value:
+            raise Exception(
+                'Checkpoint {} was created with different {}. '
+                'It cannot be resumed.'.format(self.path, description))
+
+    def set_columns(self, columns):
+        """
+        Record the feature columns of the rows, or check that they match the
+        ones of the run being resumed.
+        """
+        self._set_or_check('columns', list(columns), 'feature columns')
+
+    def set_settings(self, settings):
+        """
+        Record the (bin_width, normalize) settings of the rows, or check that
+        they match the ones of the run being resumed.
+        """
+        self._set_or_check(
+            'settings', [[bw, bool(norm)] for bw, norm in settings],
+            'bin width and normalize settings')
+
+    def set_meta(self, key, value):
+        """
+        Store a JSON-serializable value of the run (e.g., its statistics).
+        """
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+
+    def meta(self, key):
+        """
+        Value stored with set_meta, or None.
+        """
+        stored = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(stored[0]) if stored is not None else None
+
+    def columns(self):
+        """
+        Feature columns of the rows.
+        """
+        stored = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'columns'").fetchone()
+        return json.loads(stored[0]) if stored is not None else None
+
+    def done(self, image, frame, bin_width, normalize):
+        """
+        Whether the row of the (image, frame) work item and setting is
+        already stored.
+        """
+        return self._conn.execute(
+            'SELECT 1 FROM items WHERE image = ? AND frame = ? AND '
+            'bin_width = ? AND normalize = ?',
+            (image, frame, bin_width, int(normalize))).fetchone() is not None
+
+    def add(self, image, frame, name, slc, bin_width, normalize, features):  # pylint: disable=too-many-arguments
+        """
+        Commit the row of a work item.
+
+
+        Parameters
+        ----------
+        image : int
+            Index of the image
+        frame : int
+            Index of the frame in the image
+        name : str
+            Identifier of the image in the output
+        slc : int
+            Slice number written in the output
+        bin_width : float
+        normalize : bool
+        features : numpy.ndarray
+            Values of the feature columns
+        """
+        features = np.ascontiguousarray(features, dtype=np.float64)
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (image, frame, name, slc, bin_width, int(normalize),
+                 features.tobytes()))
+
+    def rows(self):
+        """
+        Iterate over the stored rows, sorted by image, frame and setting, as
+        tuples (image, frame, name, slice, bin_width, normalize, features).
+        """
+        cursor = self._conn.execute(
+            'SELECT image, frame, id, slice, bin_width, normalize, features '
+            'FROM items ORDER BY image, frame, bin_width, normalize')
+        for image, frame, name, slc, bin_width, normalize, features in cursor:
+            yield (image, frame, name, slc, bin_width, bool(normalize),
+                   np.frombuffer(features, dtype=np.float64))
+
+    def merge(self, path):
+        """
+        Copy the rows of another store (e.g., a partial checkpoint written by
+        another process or node) into this one, in a single transaction.
+        """
+        self._conn.execute('ATTACH DATABASE ? AS part', (path,))
+        try:
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO items SELECT * FROM part.items')
+        finally:
+            self._conn.execute('DETACH DATABASE part')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def close(self):
+        """
+        Close the connection to the store.
+        """
+        self._conn.close()
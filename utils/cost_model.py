@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import json
+
+"""
+Cost model of the feature extraction, used to schedule work items.
+
+The time spent on a feature class for a label is modelled as a per-class
+coefficient times a number of work units: the voxel count of the label for
+shape and first order features, scaled up with the number of grey levels for
+texture features (their matrices grow with it). The number of grey levels is
+estimated from the intensity range of the image and the bin width.
+
+The coefficients (seconds per work unit) are learned from the timings of
+previous runs, stored locally as JSON, as a running average so that a single
+unusual run does not dominate them.
+"""  # pylint: disable=pointless-string-statement
+
+TEXTURE_CLASSES = ('glcm', 'glrlm', 'glszm', 'gldm', 'ngtdm')
+# Rough seconds per work unit, until timings are learned
+DEFAULT_COEFFICIENTS = {
+    'shape': 1e-6,
+    'shape2D': 1e-6,
+    'firstorder': 2e-6,
+    'glcm': 4e-6,
+    'glrlm': 2e-6,
+    'glszm': 2e-6,
+    'gldm': 2e-6,
+    'ngtdm': 2e-6,
+}
+# Grey levels at which texture features cost twice as much as first order ones
+LEVELS_REF = 32.
+# Intensity range assumed when the header does not set cal_min and cal_max
+DEFAULT_INTENSITY_RANGE = 1000.
+
+
+def grey_levels(intensity_range, bin_width):
+    """
+    Estimated number of grey levels after discretization.
+    """
+    return max(1., float(intensity_range) / float(bin_width))
+
+
+def header_range(header):
+    """
+    Intensity range of an image from its NIfTI header (cal_min, cal_max), or
+    DEFAULT_INTENSITY_RANGE if it is not set.
+    """
+    try:
+        cal_min, cal_max = float(header['cal_min']), float(header['cal_max'])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_INTENSITY_RANGE
+    if cal_max > cal_min:
+        return cal_max - cal_min
+    return DEFAULT_INTENSITY_RANGE
+
+
+def work_units(class_name, voxels, levels):
+    """
+    Work units of computing a feature class for a label.
+    """
+    if class_name in TEXTURE_CLASSES:
+        return voxels * (1. + levels / LEVELS_REF)
+    return float(voxels)
+
+
+class CostModel(object):
+    """
+    Per-class cost coefficients, learned from previous runs.
+    """
+
+    def __init__(self, coefficients=None, runs=0):
+        self.coefficients = dict(DEFAULT_COEFFICIENTS)
+        self.coefficients.update(coefficients or {})
+        self.runs = runs
+
+    @classmethod
+    def load(cls, path):
+        """
+        Model stored in a JSON file, or the default one if it cannot be read.
+        """
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            return cls(stored['coefficients'], stored.get('runs', 0))
+        except (OSError, ValueError, KeyError, TypeError):
+            return cls()
+
+    def save(self, path):
+        """
+        Store the model in a JSON file. Failures are reported, not raised.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'coefficients': self.coefficients, 'runs': self.runs}, f)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            print('WARNING: could not save cost model:', err)
+
+    def cost(self, class_name, voxels, levels):
+        """
+        Estimated seconds of computing a feature class for a label.
+        """
+        coefficient = self.coefficients.get(class_name, DEFAULT_COEFFICIENTS['firstorder'])
+        return coefficient * work_units(class_name, voxels, levels)
+
+    def learn(self, seconds, work, weight=0.3):
+        """
+        Update the coefficients with the timings of a run.
+
+
+        Parameters
+        ----------
+        seconds : dict
+            Seconds spent on each feature class
+        work : dict
+            Work units computed for each feature class
+        weight : float
+            Weight of this run in the running average. The first run sets the
+            coefficients.
+        """
+        learned = False
+        for class_name, units in work.items():
+            if units <= 0 or seconds.get(class_name, 0) <= 0:
+                continue
+            coefficient = seconds[class_name] / float(units)
+            if self.runs > 0 and class_name in self.coefficients:
+                coefficient = (1 - weight) * self.coefficients[class_name] + weight * coefficient
+            self.coefficients[class_name] = coefficient
+            learned = True
+        if learned:
+            self.runs += 1
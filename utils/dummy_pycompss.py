@@ -15,31 +15,312 @@
 
    This code is based on the dummy functions from the pyCOMPSS module so that the
    functions can be run outside of the COMPS environment for testing purposes.
+
+   Tasks are run by a local runtime: calling a task returns a future, run on
+   a pool of threads or processes as soon as the tasks it depends on have
+   finished. A task depends on the tasks whose futures are among its
+   arguments, and on the tasks writing (FILE_OUT, FILE_INOUT) the files it
+   reads or writes. Each task takes the computing units of its @constraint
+   (default 1) from the slots of the pool, so at most `slots` units are busy
+   at a time.
+
+   The pool is selected with the COMPSS_LOCAL_EXECUTOR environment variable
+   ('process', the default, 'thread', or 'sync' to call tasks synchronously,
+   as older versions of this module did) and its slots with
+   COMPSS_LOCAL_SLOTS (default, all cores), or with configure(). Functions
+   run in a process pool must be importable by their qualified name. Tasks
+   called from inside a task are run synchronously.
 """
 
 from __future__ import print_function
+
+import os
+import inspect
+import importlib
+import threading
+import collections
+import multiprocessing.util
 from functools import wraps
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+EXECUTORS = ('thread', 'process', 'sync')
+EXECUTOR_ENV = 'COMPSS_LOCAL_EXECUTOR'
+SLOTS_ENV = 'COMPSS_LOCAL_SLOTS'
 
 
-def compss_wait_on(job):
+class LocalRuntime(object):
     """
-    Dummy wait on function
+    Local runtime running tasks on a pool of threads or processes, following
+    the dependencies between them.
     """
-    return job
+
+    def __init__(self, executor=None, slots=None):
+        executor = executor or os.environ.get(EXECUTOR_ENV) or 'process'
+        if executor not in EXECUTORS:
+            raise ValueError('Unknown executor "{}". Use one of {}'.format(
+                executor, ', '.join(EXECUTORS)))
+        if slots is None:
+            slots = int(os.environ.get(SLOTS_ENV) or 0) or os.cpu_count() or 1
+        self.executor = executor
+        self.slots = max(1, int(slots))
+        self._free = self.slots
+        self._pool = None
+        self._lock = threading.Lock()
+        self._ready = collections.deque()
+        self._outstanding = set()
+        # Last task writing each file, and tasks reading it since
+        self._writers = {}
+        self._readers = {}
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.slots)
+                # A multiprocessing child (e.g., running a batch job) skips
+                # the atexit hooks and waits for its children when exiting:
+                # shut the pool down first, before its queues are closed
+                # (their finalizers have priority 10)
+                multiprocessing.util.Finalize(self, self.shutdown, exitpriority=20)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.slots)
+        return self._pool
+
+    def submit(self, function, args, kwargs, units=1, files_in=(), files_out=()):
+        """
+        Schedule a call of function, once its dependencies have finished.
+
+        Returns a concurrent.futures.Future of its result.
+        """
+        future = Future()
+        units = max(1, min(int(units), self.slots))
+        with self._lock:
+            deps = set(_futures((args, kwargs)))
+            for path in files_in:
+                if path in self._writers:
+                    deps.add(self._writers[path])
+                self._readers.setdefault(path, set()).add(future)
+            for path in files_out:
+                if path in self._writers:
+                    deps.add(self._writers[path])
+                deps.update(self._readers.pop(path, ()))
+                self._writers[path] = future
+            deps.discard(future)
+            self._outstanding.add(future)
+
+        files = set(files_in) | set(files_out)
+        pending = [len(deps) + 1]
+        pending_lock = threading.Lock()
+
+        def dependency_done(_):
+            with pending_lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            failed = [dep for dep in deps if dep.exception() is not None]
+            if failed:
+                self._finish(future, files, exception=failed[0].exception())
+                return
+            with self._lock:
+                self._ready.append(
+                    (future, files, units, function, _resolve(args), _resolve(kwargs)))
+            self._dispatch()
+
+        for dep in deps:
+            dep.add_done_callback(dependency_done)
+        dependency_done(None)
+        return future
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            while self._ready and self._ready[0][2] <= self._free:
+                item = self._ready.popleft()
+                self._free -= item[2]
+                started.append(item)
+        for future, files, units, function, args, kwargs in started:
+            if self.executor == 'process':
+                running = self._get_pool().submit(
+                    _call_task, function.__module__, function.__qualname__, args, kwargs)
+            else:
+                running = self._get_pool().submit(_call_inline, function, args, kwargs)
+            running.add_done_callback(
+                lambda done, future=future, files=files, units=units:
+                self._task_done(done, future, files, units))
+
+    def _task_done(self, done, future, files, units):
+        with self._lock:
+            self._free += units
+        if done.exception() is not None:
+            self._finish(future, files, exception=done.exception())
+        else:
+            self._finish(future, files, result=done.result())
+        self._dispatch()
+
+    def _finish(self, future, files, result=None, exception=None):
+        with self._lock:
+            for path in files:
+                if self._writers.get(path) is future:
+                    del self._writers[path]
+                if path in self._readers:
+                    self._readers[path].discard(future)
+                    if not self._readers[path]:
+                        del self._readers[path]
+            self._outstanding.discard(future)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def wait_file(self, path):
+        """
+        Wait for the task writing a file, if any.
+        """
+        with self._lock:
+            writer = self._writers.get(os.path.abspath(path))
+        if writer is not None:
+            wait([writer])
+
+    def barrier(self):
+        """
+        Wait for all the outstanding tasks, including those they submit.
+        """
+        while True:
+            with self._lock:
+                outstanding = list(self._outstanding)
+            if not outstanding:
+                return
+            wait(outstanding)
+
+    def shutdown(self):
+        """
+        Wait for all the outstanding tasks and release the pool.
+        """
+        self.barrier()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+_runtime = None  # pylint: disable=invalid-name
+_runtime_lock = threading.Lock()  # pylint: disable=invalid-name
+# Set while running a task, so that nested tasks are run synchronously
+_in_task = threading.local()  # pylint: disable=invalid-name
+
+
+def get_runtime():
+    """
+    Local runtime of the tasks, created on first use.
+    """
+    global _runtime  # pylint: disable=global-statement,invalid-name
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = LocalRuntime()
+        return _runtime
+
+
+def configure(executor=None, slots=None):
+    """
+    Replace the local runtime, once the tasks of the current one finish.
+
+    :param executor: 'thread', 'process' or 'sync'
+    :param slots: number of computing units run at a time. Default, all cores.
+    """
+    global _runtime  # pylint: disable=global-statement,invalid-name
+    with _runtime_lock:
+        previous, _runtime = _runtime, LocalRuntime(executor, slots)
+    if previous is not None:
+        previous.shutdown()
+    return _runtime
+
+
+def _call_inline(function, args, kwargs):
+    _in_task.active = True
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _in_task.active = False
+
+
+def _call_task(module, qualname, args, kwargs):
+    """
+    Run a task in a worker process, finding it by its qualified name (the
+    function itself cannot be pickled, it is replaced by the task wrapper).
+    """
+    function = importlib.import_module(module)
+    for name in qualname.split('.'):
+        function = getattr(function, name)
+    return _call_inline(getattr(function, '__wrapped__', function), args, kwargs)
+
+
+def _futures(obj):
+    if isinstance(obj, Future):
+        yield obj
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            for future in _futures(item):
+                yield future
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            for future in _futures(item):
+                yield future
+
+
+def _resolve(obj):
+    if isinstance(obj, Future):
+        return _resolve(obj.result())
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*(_resolve(item) for item in obj))
+    if isinstance(obj, (list, tuple, set)):
+        return type(obj)(_resolve(item) for item in obj)
+    if isinstance(obj, dict):
+        return type(obj)((key, _resolve(value)) for key, value in obj.items())
+    return obj
+
+
+def _split_returns(future, returns):
+    """
+    Futures of each of the values returned by a task with several returns.
+    """
+    futures = tuple(Future() for _ in range(returns))
+
+    def done(_):
+        if future.exception() is not None:
+            for item in futures:
+                item.set_exception(future.exception())
+        else:
+            for item, value in zip(futures, future.result()):
+                item.set_result(value)
+    future.add_done_callback(done)
+    return futures
+
+
+def compss_wait_on(*args):
+    """
+    Wait for the futures returned by tasks, also inside lists, tuples and
+    dicts, and return their values
+    """
+    values = tuple(_resolve(arg) for arg in args)
+    return values[0] if len(values) == 1 else list(values)
 
 
 def compss_open(job, *args, **kwargs):  # pylint: disable=unused-argument
     """
-    Dummy open function required when copying from out of the COMPSs system
+    Dummy open function required when copying from out of the COMPSs system.
+    Waits for the task writing the file, if any
     """
+    get_runtime().wait_file(job)
     return job
 
 
 def compss_delete_file(job, *args, **kwargs):  # pylint: disable=unused-argument
     """
-    Dummy delete file function required when deleting files in the COMPSs system
+    Dummy delete file function required when deleting files in the COMPSs system.
+    Waits for the task writing the file, if any, and removes it
     """
-    pass
+    get_runtime().wait_file(job)
+    if os.path.exists(job):
+        os.remove(job)
+    return True
 
 
 def compss_delete_object(job, *args, **kwargs):  # pylint: disable=unused-argument
@@ -56,11 +337,11 @@ def compss_delete(*args, **kwargs):  # pylint: disable=unused-argument
     pass
 
 
-def barrier():
+def barrier(no_more_tasks=False):  # pylint: disable=unused-argument
     """
-    Dummy function to trigger the pipeline to wait till all jobs have completed
+    Wait till all the outstanding tasks have completed
     """
-    pass
+    get_runtime().barrier()
 
 
 def local(job):
@@ -73,7 +354,8 @@ def local(job):
 
 class constraint(object):  # pylint: disable=invalid-name,too-few-public-methods
     """
-    Dummy function for handling the contraint decorators
+    Constraint decorator. Only computing_units is used, as the number of
+    slots of the local runtime taken by the task
     """
     @wraps(object)
     def __init__(self, *args, **kwargs):
@@ -81,18 +363,13 @@ class constraint(object):  # pylint: disable=invalid-name,too-few-public-methods
         self.kwargs = kwargs
 
     def __call__(self, function):
-        @wraps(function)
-        def wrapped_f(*args, **kwargs):
-            """
-            Function wrapper for the decorator
-            """
-            return function(*args, **kwargs)
-        return wrapped_f
+        function.compss_constraints = self.kwargs
+        return function
 
 
 class task(object):  # pylint: disable=invalid-name,too-few-public-methods
     """
-    Dummy function for handling the task decorators
+    Task decorator. Calls return futures, run by the local runtime
     """
 
     @wraps(object)
@@ -101,14 +378,52 @@ class task(object):  # pylint: disable=invalid-name,too-few-public-methods
         self.kwargs = kwargs
 
     def __call__(self, function):
+        signature = inspect.signature(function)
+        returns = self.kwargs.get('returns')
+
         @wraps(function)
         def wrapped_f(*args, **kwargs):
             """
             Function wrapper for the decorator
             """
-            return function(*args, **kwargs)
+            runtime = get_runtime()
+            if runtime.executor == 'sync' or getattr(_in_task, 'active', False):
+                return function(*args, **kwargs)
+
+            files_in, files_out = self._files(signature.bind(*args, **kwargs))
+            units = getattr(wrapped_f, 'compss_constraints', {}).get('computing_units', 1)
+            future = runtime.submit(function, args, kwargs, units, files_in, files_out)
+            if isinstance(returns, int) and returns > 1:
+                return _split_returns(future, returns)
+            return future
         return wrapped_f
 
+    def _files(self, bound):
+        """
+        Files read and written by a call, from the FILE parameters of the
+        decorator (varargsType applies to the *args of the function).
+        """
+        files_in, files_out = [], []
+        for name, value in bound.arguments.items():
+            kind = bound.signature.parameters[name].kind
+            if kind == inspect.Parameter.VAR_POSITIONAL:
+                param, values = self.kwargs.get('varargsType'), value
+            elif kind == inspect.Parameter.VAR_KEYWORD:
+                continue
+            else:
+                param, values = self.kwargs.get(name), [value]
+            if not isinstance(param, Parameter) or param.type != Type.FILE:
+                continue
+            for path in values:
+                if not isinstance(path, str):
+                    continue
+                path = os.path.abspath(path)
+                if param.direction == Direction.IN:
+                    files_in.append(path)
+                else:
+                    files_out.append(path)
+        return files_in, files_out
+
 
 # Numbers match both C and Java enums
 class Direction(object):  # pylint: disable=too-few-public-methods
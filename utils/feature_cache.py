@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+
+import SimpleITK as sitk
+
+"""
+Persistent cache of extracted features, shared across runs and projects.
+
+Entries hold the features of one label of one frame, keyed by a hash of the
+content of the frame and of the mask (voxels and geometry), the label, the
+effective extractor settings and the pyradiomics version. Hence the same
+patient frame processed again with the same Params.yaml and setting is served
+from the cache, whatever the file names or run folders, and any change in the
+inputs or the settings is a miss.
+
+The cache is a single SQLite file. Entries are committed one at a time, so
+several processes may share it, and the least recently used ones are removed
+when the total size of the entries exceeds the size cap.
+"""  # pylint: disable=pointless-string-statement
+
+DEFAULT_FEATURE_CACHE_SIZE = 2048  # MB
+
+
+def image_digest(img):
+    """
+    Hash of the voxels and geometry of a SimpleITK image.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    arr = sitk.GetArrayViewFromImage(img)
+    digest.update(json.dumps([
+        str(arr.dtype), arr.shape, img.GetSpacing(), img.GetOrigin(),
+        img.GetDirection()
+    ]).encode())
+    digest.update(memoryview(arr).cast('B') if arr.flags.c_contiguous else arr.tobytes())
+    return digest.hexdigest()
+
+
+def settings_digest(extractor, version):
+    """
+    Hash of the settings, image types and features of an extractor, and of the
+    pyradiomics version.
+    """
+    key = json.dumps([
+        version, extractor.settings, extractor.enabledImagetypes,
+        extractor.enabledFeatures
+    ], sort_keys=True, default=str)
+    return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Size-capped store of feature values, keyed by content hashes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_FEATURE_CACHE_SIZE * 2**20, timeout=600):
+        """
+        Open (and create, if needed) the cache.
+
+
+        Parameters
+        ----------
+        path : str
+            SQLite file of the cache
+        max_bytes : int
+            Size cap of the stored entries
+        timeout : float
+            Seconds to wait for other processes holding the write lock.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        # Estimate of the size of the entries, refreshed on eviction, so the
+        # entries are not summed up on every insertion
+        self._nbytes = self._size()
+
+    def _size(self):
+        return self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    @staticmethod
+    def key(frame_digest, mask_digest, label, extractor_digest):
+        """
+        Key of the features of a label of a frame.
+        """
+        return hashlib.blake2b('{}:{}:{}:{}'.format(
+            frame_digest, mask_digest, label, extractor_digest).encode(),
+            digest_size=20).hexdigest()
+
+    def get(self, key):
+        """
+        Features stored under key, as a list of (name, value) pairs, or None.
+        """
+        row = self._conn.execute(
+            'SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._conn:
+            self._conn.execute(
+                'UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        return [tuple(item) for item in json.loads(row[0])]
+
+    def put(self, key, features):
+        """
+        Store a list of (name, value) pairs under key, evicting the least
+        recently used entries if the cache exceeds its size cap.
+        """
+        value = json.dumps([(name, float(val)) for name, val in features])
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, value, len(value), time.time()))
+        self._nbytes += len(value)
+        if self._nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        total = self._size()
+        self._nbytes = total
+        if total <= self.max_bytes:
+            return
+        with self._conn:
+            cursor = self._conn.execute('SELECT key, size FROM entries ORDER BY used')
+            stale = []
+            for key, size in cursor:
+                if total <= self.max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            self._conn.executemany('DELETE FROM entries WHERE key = ?', stale)
+        self._nbytes = total
+
+    def stats(self):
+        """
+        Counters of the cache, as a dict.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """
+        Close the connection to the cache.
+        """
+        self._conn.close()
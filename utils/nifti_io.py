@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+
+try:
+    import indexed_gzip as igzip
+except ImportError:
+    igzip = None  # pylint: disable=invalid-name
+
+"""
+Loading of NIfTI volumes as SimpleITK images.
+
+Voxel data is read through the nibabel array proxy, so it keeps the dtype
+stored on disk (e.g. int16 images and uint8 masks) unless scaling is set in
+the header, and single frames of 4D files are read without loading the whole
+series. SimpleITK can only import NumPy arrays by copying them, so the
+decoded array is released as soon as the image is built; use
+``SimpleITK.GetArrayViewFromImage`` to get NumPy views of the image without
+copying it back.
+
+As in the rest of the tool, the NumPy array is handed to SimpleITK as is, hence
+the axes of the SimpleITK image are the NIfTI axes in reverse order. The
+spacing, origin and direction of the image are set accordingly from the NIfTI
+affine (converted from RAS to the LPS convention of ITK).
+
+When indexed_gzip is installed, frames of gzipped 4D files are read through a
+seekable gzip index, so reading frame j does not inflate frames 0..j-1. The
+index is built on the first read and saved beside the input or, if that
+directory is not writable, in the local cache folder. The indexed files stay
+open (with their index in memory) for the next frames read by this process.
+"""  # pylint: disable=pointless-string-statement
+
+GZIP_INDEX_SUFFIX = '.gzidx'
+# Fallback folder of the indexes of inputs in read-only folders
+GZIP_INDEX_CACHE_DIR = os.path.join(os.environ.get(
+    'VRE_RADIOMICS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'vre_radiomics')), 'gzidx')
+# Indexed gzipped files kept open by this process
+MAX_OPEN_FILES = 8
+
+# {(path, mtime, size): (IndexedGzipFile, lock)}
+_open_files = OrderedDict()
+_open_files_lock = threading.Lock()
+
+
+def nifti_geometry(nii):
+    """
+    Geometry of the SimpleITK image built from the voxel array of a NIfTI.
+
+
+    Parameters
+    ----------
+    nii : nibabel.Nifti1Image
+
+
+    Returns
+    -------
+    (spacing, origin, direction)
+        tuples ready for the SimpleITK setters
+    """
+    affine = nii.affine
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    zooms[zooms == 0] = 1
+    ras_to_lps = np.diag([-1., -1., 1.])
+    axes = ras_to_lps.dot(affine[:3, :3] / zooms)
+    origin = ras_to_lps.dot(affine[:3, 3])
+    # SimpleITK reads the array axes in reverse order
+    return (
+        tuple(float(z) for z in zooms[::-1]),
+        tuple(float(o) for o in origin),
+        tuple(float(d) for d in axes[:, ::-1].flatten())
+    )
+
+
+def read_array(nii, frame=None, dtype=None):
+    """
+    Voxel data of a NIfTI, or of a single frame of a 4D NIfTI.
+
+
+    Parameters
+    ----------
+    nii : nibabel.Nifti1Image
+    frame : int
+        Frame to read from a 4D file. The whole volume is read when None.
+    dtype : str
+        Data type to cast the voxels to (e.g. 'float32'). Default keeps the
+        data type stored on disk.
+
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if frame is None:
+        arr = np.asanyarray(nii.dataobj)
+    else:
+        arr = np.asanyarray(nii.dataobj[..., frame])
+    if dtype is not None:
+        arr = arr.astype(dtype, copy=False)
+    return arr
+
+
+def index_paths(path, cache_dir=GZIP_INDEX_CACHE_DIR):
+    """
+    Candidate locations of the seek-point index of a gzipped file: beside it
+    and, if given, in the cache directory.
+    """
+    paths = [path + GZIP_INDEX_SUFFIX]
+    if cache_dir is not None:
+        digest = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+        paths.append(os.path.join(cache_dir, digest + GZIP_INDEX_SUFFIX))
+    return paths
+
+
+def open_indexed_gzip(path, cache_dir=GZIP_INDEX_CACHE_DIR):
+    """
+    Open a gzipped file for random access, reusing a seek-point index saved
+    beside it (or in cache_dir) when it is newer than the file, or building
+    it and saving it in the first writable location.
+
+
+    Parameters
+    ----------
+    path : str
+        gzipped file
+    cache_dir : str
+        Fallback folder of the index, used when the folder of the file is not
+        writable
+
+
+    Returns
+    -------
+    indexed_gzip.IndexedGzipFile
+    """
+    indexes = index_paths(path, cache_dir)
+    fobj = igzip.IndexedGzipFile(path)
+    for index in indexes:
+        try:
+            if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(path):
+                fobj.import_index(index)
+                return fobj
+        except Exception:  # pylint: disable=broad-except
+            # Corrupted or incompatible index: try the next one, or rebuild it
+            fobj.close()
+            fobj = igzip.IndexedGzipFile(path)
+
+    fobj.build_full_index()
+    for index in indexes:
+        tmp_index = '{}.{}.tmp'.format(index, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index)), exist_ok=True)
+            fobj.export_index(tmp_index)
+            os.replace(tmp_index, index)
+            break
+        except Exception:  # pylint: disable=broad-except
+            if os.path.exists(tmp_index):
+                os.remove(tmp_index)
+    return fobj
+
+
+def indexed_gzip_file(path):
+    """
+    Indexed gzipped file kept open by this process, and the lock to hold while
+    reading it. Files changed on disk are reopened, and the least recently
+    used ones are closed beyond MAX_OPEN_FILES.
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    with _open_files_lock:
+        if key in _open_files:
+            _open_files.move_to_end(key)
+            return _open_files[key]
+    entry = (open_indexed_gzip(path), threading.Lock())
+    with _open_files_lock:
+        if key in _open_files:
+            # Opened by another thread meanwhile
+            entry[0].close()
+            return _open_files[key]
+        _open_files[key] = entry
+        stale = []
+        while len(_open_files) > MAX_OPEN_FILES:
+            stale.append(_open_files.popitem(last=False)[1])
+    for fobj, lock in stale:
+        with lock:
+            fobj.close()
+    return entry
+
+
+def load_image(path, frame=None, dtype=None, geometry=True):
+    """
+    Load a NIfTI, or a single frame of a 4D NIfTI, as a SimpleITK image.
+
+
+    Parameters
+    ----------
+    path : str
+        NIfTI file to read
+    frame : int
+        Frame to read from a 4D file. It is ignored for 3D files.
+    dtype : str
+        Data type of the voxels, see ``read_array``.
+    geometry : bool
+        Set spacing, origin and direction from the NIfTI affine. Otherwise
+        the image has unit spacing and identity direction.
+
+
+    Returns
+    -------
+    SimpleITK.Image
+    """
+    nii = nib.load(path)
+    if len(nii.shape) != 4:
+        frame = None
+    if frame is not None and igzip is not None and path.endswith('.gz'):
+        fobj, lock = indexed_gzip_file(path)
+        with lock:
+            fobj.seek(0)
+            holder = nib.FileHolder(path, fobj)
+            nii = nib.Nifti1Image.from_file_map({'header': holder, 'image': holder})
+            img = sitk.GetImageFromArray(read_array(nii, frame, dtype))
+    else:
+        img = sitk.GetImageFromArray(read_array(nii, frame, dtype))
+    if geometry:
+        spacing, origin, direction = nifti_geometry(nii)
+        img.SetSpacing(spacing)
+        img.SetOrigin(origin)
+        img.SetDirection(direction)
+    return img
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+"""
+Validation of the inputs of a job before any voxel is read.
+
+Every (image, mask) pair is checked from the NIfTI headers only, several pairs
+at a time, and all the problems found are returned together, so that a job
+with bad inputs fails in seconds with a complete report instead of after hours
+of extraction.
+"""  # pylint: disable=pointless-string-statement
+
+# Maximum number of headers read at the same time
+MAX_THREADS = 16
+
+
+def check_pair(k, image, mask, slices_of_interest=None, geometry=True, tolerance=1e-3):
+    """
+    Problems of an (image, mask) pair, found from their headers.
+
+
+    Parameters
+    ----------
+    k : int
+        Index of the pair, used in the messages
+    image : str
+        3D or 4D NIfTI image
+    mask : str
+        3D NIfTI mask
+    slices_of_interest : tuple
+        Frames of the image to extract (e.g., (ED, ES)), or None
+    geometry : bool
+        Whether the affines of the image and the mask must match
+    tolerance : float
+        Tolerance of the affine comparison
+
+
+    Returns
+    -------
+    list of str
+    """
+    problems = []
+    try:
+        img = nib.load(image)
+    except Exception as err:  # pylint: disable=broad-except
+        return ['image {} ({}) cannot be read: {}'.format(k, image, err)]
+    try:
+        mk = nib.load(mask)
+    except Exception as err:  # pylint: disable=broad-except
+        return ['mask {} ({}) cannot be read: {}'.format(k, mask, err)]
+
+    if len(img.shape) not in (3, 4):
+        problems.append('image {} ({}) has shape {}. Supported shapes are in 3D or '
+                        '4D formats'.format(k, image, img.shape))
+    if len(mk.shape) != 3:
+        problems.append('mask {} ({}) has shape {}. Masks must be 3D'.format(
+            k, mask, mk.shape))
+    elif img.shape[:3] != mk.shape:
+        problems.append('image {} ({}) has shape {} but its mask ({}) has shape {}'.format(
+            k, image, img.shape[:3], mask, mk.shape))
+    elif geometry and not np.allclose(img.affine, mk.affine, atol=tolerance):
+        problems.append('image {} ({}) and its mask ({}) have different affines'.format(
+            k, image, mask))
+
+    if len(img.shape) == 4 and slices_of_interest is not None:
+        n_frames = img.shape[-1]
+        wrong = [j for j in slices_of_interest if not 0 <= j < n_frames]
+        if wrong:
+            problems.append('image {} ({}) has {} frames, so frames {} (ED/ES) are out of '
+                            'bounds'.format(k, image, n_frames, wrong))
+    return problems
+
+
+def preflight(images, masks, slices_of_interest=None, geometry=True, tolerance=1e-3):
+    """
+    Problems of the inputs of a job: different number of images and masks,
+    unreadable files, unsupported dimensions, shape or affine mismatches
+    between images and masks, and ED/ES frames out of bounds.
+
+
+    Parameters
+    ----------
+    images : list
+        Image filenames
+    masks : list
+        Mask filenames, one per image
+    slices_of_interest : list
+        Frames of interest of each image, or None
+    geometry : bool
+        Whether the affines of images and masks must match
+    tolerance : float
+        Tolerance of the affine comparison
+
+
+    Returns
+    -------
+    list of str
+        Empty if the job can be run
+    """
+    problems = []
+    if len(images) != len(masks):
+        problems.append('found different number of images versus masks: {} vs. {}'.format(
+            len(images), len(masks)))
+    if slices_of_interest is None:
+        slices_of_interest = [None] * len(images)
+
+    pairs = list(zip(images, masks, slices_of_interest))
+    if pairs:
+        with ThreadPoolExecutor(max_workers=min(MAX_THREADS, len(pairs))) as pool:
+            results = pool.map(
+                lambda args: check_pair(args[0], *args[1], geometry=geometry,
+                                        tolerance=tolerance),
+                enumerate(pairs))
+            for result in results:
+                problems.extend(result)
+    return problems
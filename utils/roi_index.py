@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+"""
+Index of the labels (ROIs) of a mask.
+
+A single pass over the mask voxels counts the voxels of every label (with
+``numpy.bincount``) and finds their bounding boxes (with
+``scipy.ndimage.find_objects``), so that atlas-style masks with many labels
+are not scanned once per label. Bounding boxes are given as (start, stop)
+pairs along the axes of the NumPy array of the mask, i.e. in reverse order of
+the SimpleITK image axes.
+
+The index of a mask file is saved in a small JSON sidecar beside it (or in a
+cache directory, if that folder is not writable), together with a hash of the
+voxels, and reused while the size and modification time of the mask match.
+Hence the labels of a whole cohort can be listed without decoding any mask.
+"""  # pylint: disable=pointless-string-statement
+
+SIDECAR_SUFFIX = '.roi.json'
+SIDECAR_VERSION = 1
+
+
+def label_index(arr):
+    """
+    Voxel count and bounding box of every label present in a mask.
+
+
+    Parameters
+    ----------
+    arr : numpy.ndarray
+        Voxels of the mask. Values are truncated to integers, as done by the
+        extraction, and those not above 0 are the background.
+
+
+    Returns
+    -------
+    dict
+        {label: (count, ((start, stop), ...))}, sorted by label
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.kind == 'b':
+        arr = arr.astype(np.uint8)
+    elif arr.dtype.kind == 'f':
+        arr = np.where(np.isfinite(arr), arr, 0).astype(np.int64)
+    elif arr.dtype == np.uint64:
+        # bincount only takes types safely castable to int64
+        arr = arr.astype(np.int64)
+    if arr.size > 0 and arr.min() < 0:
+        arr = np.maximum(arr, 0)
+
+    counts = np.bincount(arr.ravel())
+    index = {}
+    for lb, slc in enumerate(ndimage.find_objects(arr), start=1):
+        if slc is None:
+            continue
+        index[lb] = (int(counts[lb]), tuple((int(s.start), int(s.stop)) for s in slc))
+    return index
+
+
+def crop_box(bbox, shape, pad=0):
+    """
+    Bounding box grown by pad voxels on every side, clipped to the shape of
+    the array.
+    """
+    return tuple(
+        (max(0, start - pad), min(size, stop + pad))
+        for (start, stop), size in zip(bbox, shape))
+
+
+def voxels_digest(arr):
+    """
+    Hash of the voxels of an array, with its data type and shape.
+    """
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update('{}{}'.format(arr.dtype.str, arr.shape).encode())
+    digest.update(memoryview(arr).cast('B'))
+    return digest.hexdigest()
+
+
+def sidecar_paths(path, cache_dir=None):
+    """
+    Candidate locations of the sidecar of a mask: beside it and, if given, in
+    the cache directory.
+    """
+    paths = [path + SIDECAR_SUFFIX]
+    if cache_dir is not None:
+        digest = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+        paths.append(os.path.join(cache_dir, 'roi', digest + '.json'))
+    return paths
+
+
+def read_sidecar(path, cache_dir=None):
+    """
+    Contents of the sidecar of a mask, or None if there is no sidecar matching
+    the current size and modification time of the mask.
+    """
+    stat = os.stat(path)
+    for sidecar in sidecar_paths(path, cache_dir):
+        try:
+            with open(sidecar) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if info.get('version') == SIDECAR_VERSION and \
+                info.get('mtime_ns') == stat.st_mtime_ns and info.get('size') == stat.st_size:
+            return info
+    return None
+
+
+def write_sidecar(path, info, cache_dir=None):
+    """
+    Save the sidecar of a mask in the first writable location. Returns its
+    path, or None if it could not be written.
+    """
+    for sidecar in sidecar_paths(path, cache_dir):
+        tmp_sidecar = '{}.{}.tmp'.format(sidecar, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(sidecar)), exist_ok=True)
+            with open(tmp_sidecar, 'w') as f:
+                json.dump(info, f)
+            os.replace(tmp_sidecar, sidecar)
+            return sidecar
+        except OSError:
+            if os.path.exists(tmp_sidecar):
+                os.remove(tmp_sidecar)
+    return None
+
+
+def mask_rois(path, cache_dir=None, arr=None):
+    """
+    Index of the labels of a mask file, read from its sidecar when it is fresh
+    or computed (and saved) otherwise.
+
+
+    Parameters
+    ----------
+    path : str
+        NIfTI mask
+    cache_dir : str
+        Fallback folder of the sidecar, used when the folder of the mask is
+        not writable
+    arr : numpy.ndarray
+        Voxels of the mask, if already decoded
+
+
+    Returns
+    -------
+    dict
+        Sidecar contents. Its 'labels' are {label: (count, bbox)}, as returned
+        by ``label_index``.
+    """
+    info = read_sidecar(path, cache_dir)
+    if info is None:
+        stat = os.stat(path)
+        if arr is None:
+            arr = np.asanyarray(nib.load(path).dataobj)
+        index = label_index(arr)
+        info = {
+            'version': SIDECAR_VERSION,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'shape': list(arr.shape),
+            'hash': voxels_digest(arr),
+            'labels': {
+                str(lb): {'count': count, 'bbox': [list(b) for b in bbox]}
+                for lb, (count, bbox) in index.items()
+            }
+        }
+        write_sidecar(path, info, cache_dir)
+
+    info = dict(info)
+    info['labels'] = {
+        int(lb): (roi['count'], tuple(tuple(b) for b in roi['bbox']))
+        for lb, roi in sorted(info['labels'].items(), key=lambda item: int(item[0]))
+    }
+    return info
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import gzip
+import shutil
+import hashlib
+import threading
+
+"""
+Scratch cache of decompressed NIfTI files.
+
+nibabel cannot memory-map gzipped files, so reading frame j of a 4D .nii.gz
+inflates the stream up to that frame every time. Staging an input inflates it
+once into an uncompressed .nii in the scratch directory, named after the hash
+of its content, which nibabel then memory-maps so that every frame read only
+pages in that frame. Several processes (or threads) may stage the same file at
+the same time: each one writes its own temporary file, which is atomically
+renamed to the same content-addressed name.
+
+When the scratch directory grows beyond its size cap, the least recently used
+files are removed. Files being read by other processes stay readable until
+they are closed.
+"""  # pylint: disable=pointless-string-statement
+
+DEFAULT_SCRATCH_SIZE = 20480  # MB
+
+
+class ScratchCache(object):
+    """
+    Directory of decompressed copies of .nii.gz inputs, capped in size.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_SCRATCH_SIZE * 2**20):
+        """
+        Initialise the cache, creating its directory if needed.
+
+
+        Parameters
+        ----------
+        directory : str
+            Scratch directory, ideally on a local disk
+        max_bytes : int
+            Size cap of the directory
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def digest(self, path):
+        """
+        Hash of the content of a file, memoized by path, mtime and size.
+        """
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+        if key not in self._digests:
+            digest = hashlib.blake2b(digest_size=20)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    digest.update(block)
+            self._digests[key] = digest.hexdigest()
+        return self._digests[key]
+
+    def stage(self, path):
+        """
+        Uncompressed copy of a .nii.gz file. Other files are returned as is.
+
+
+        Parameters
+        ----------
+        path : str
+            NIfTI file
+
+
+        Returns
+        -------
+        str
+            Path of a file with the same content that can be memory-mapped
+        """
+        if not path.endswith('.gz'):
+            return path
+
+        target = os.path.join(self.directory, self.digest(path) + '.nii')
+        try:
+            # Mark as recently used
+            os.utime(target)
+            return target
+        except FileNotFoundError:
+            pass
+
+        tmp_target = '{}.{}.{}.tmp'.format(target, os.getpid(), threading.get_ident())
+        with gzip.open(path, 'rb') as src, open(tmp_target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 2**22)
+        os.replace(tmp_target, target)
+        self._evict(keep=target)
+        return target
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.nii'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.directory, name)
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import nibabel as nib
+
+from utils.nifti_io import load_image
+from utils.scratch import ScratchCache, DEFAULT_SCRATCH_SIZE
+
+"""
+Bounded in-memory cache of decoded volumes.
+
+Volumes are served as SimpleITK images (see utils.nifti_io), and 4D files can
+be requested one frame at a time; NumPy arrays are obtained as views of the
+cached images with ``SimpleITK.GetArrayViewFromImage``, so no second copy is
+kept. Entries are keyed by the file path, its modification time and size, the
+frame and the loading options, so a file rewritten on disk is never served
+stale. When the memory budget is exceeded, the least recently used entries are
+evicted.
+
+Optionally, gzipped inputs are inflated once into a scratch directory (see
+utils.scratch) and read from there, so that frames are memory-mapped.
+
+Each process holds its own cache (see ``volume_cache``), shared by its
+threads, whose memory budget is set with ``configure``. The loading options
+(data type, geometry, scratch directory) are given with every request, as
+extractions with different options may run in the same process.
+"""  # pylint: disable=pointless-string-statement
+
+DEFAULT_CACHE_SIZE = 1024  # MB
+
+# Options of the volumes loaded by an extraction: memory budget (MB) of the
+# cache, data type of the image voxels, whether to set the geometry from the
+# NIfTI affine, and scratch directory of the gzipped inputs and its size cap
+# (MB)
+Loading = namedtuple(
+    'Loading', ['cache_size', 'dtype', 'geometry', 'scratch_dir', 'scratch_size'],
+    defaults=(None, None, True, None, None))
+
+
+class VolumeCache(object):
+    """
+    LRU cache of decoded volumes with a memory budget in bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE * 2**20):
+        """
+        Initialise an empty cache.
+
+
+        Parameters
+        ----------
+        max_bytes : int
+            Memory budget of the cache. Volumes larger than the budget are
+            decoded but never stored.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Hits and misses of the requests of each thread
+        self._thread_counts = threading.local()
+
+    @staticmethod
+    def _key(path, frame, dtype, geometry):
+        stat = os.stat(path)
+        return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size, frame,
+                dtype, geometry)
+
+    def _get(self, key):
+        counts = self._thread_counts
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                counts.hits = getattr(counts, 'hits', 0) + 1
+                return self._entries[key][0]
+            self.misses += 1
+            counts.misses = getattr(counts, 'misses', 0) + 1
+            return None
+
+    def _put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            # Another thread may have loaded the same volume meanwhile
+            if key in self._entries:
+                self.nbytes -= self._entries[key][1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+    def _evict(self):
+        # Called with the lock held
+        while self.nbytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def resize(self, max_bytes):
+        """
+        Change the memory budget, evicting entries if needed.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Drop every entry and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _load(self, path, frame, dtype, geometry, scratch):
+        if frame is not None and len(nib.load(path).shape) != 4:
+            frame = None
+        key = self._key(path, frame, dtype, geometry)
+        img = self._get(key)
+        if img is None:
+            source = path if scratch is None else scratch.stage(path)
+            img = load_image(source, frame, dtype=dtype, geometry=geometry)
+            nbytes = img.GetNumberOfPixels() * img.GetNumberOfComponentsPerPixel() * \
+                img.GetSizeOfPixelComponent()
+            self._put(key, img, nbytes)
+        return img
+
+    def get_image(self, path, frame=None, dtype=None, geometry=True, scratch=None):  # pylint: disable=too-many-arguments
+        """
+        Decoded image.
+
+
+        Parameters
+        ----------
+        path : str
+            NIfTI file to read
+        frame : int
+            Frame to read from a 4D file. It is ignored for 3D files, and the
+            whole volume is returned when it is None.
+        dtype : str
+            Data type of the voxels (e.g. 'float32'). Default keeps the data
+            type stored on disk.
+        geometry : bool
+            Set spacing, origin and direction of the volume from the NIfTI
+            affine.
+        scratch : utils.scratch.ScratchCache
+            Scratch cache where gzipped files are staged, if any
+
+
+        Returns
+        -------
+        SimpleITK.Image
+        """
+        return self._load(path, frame, dtype, geometry, scratch)
+
+    def get_mask(self, path, geometry=True, scratch=None):
+        """
+        Decoded mask, with voxels of the data type stored on disk. See
+        get_image.
+
+
+        Returns
+        -------
+        SimpleITK.Image
+        """
+        return self._load(path, None, None, geometry, scratch)
+
+    def thread_counts(self):
+        """
+        Hits and misses of the requests made by the calling thread.
+        """
+        counts = self._thread_counts
+        return getattr(counts, 'hits', 0), getattr(counts, 'misses', 0)
+
+    def stats(self):
+        """
+        Counters of the cache, as a dict.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self.nbytes
+            }
+
+
+# Cache shared by everything running in this process
+volume_cache = VolumeCache()  # pylint: disable=invalid-name
+# Scratch caches of this process, by directory and size cap
+_scratch_caches = {}
+_scratch_caches_lock = threading.Lock()
+
+
+def configure(cache_size=None):
+    """
+    Set the memory budget (MB) of this process' cache. Used as the
+    initializer of worker processes.
+    """
+    if cache_size is None:
+        cache_size = DEFAULT_CACHE_SIZE
+    volume_cache.resize(int(cache_size * 2**20))
+
+
+def scratch_cache(scratch_dir=None, scratch_size=None):
+    """
+    Scratch cache of this process staging gzipped inputs in scratch_dir,
+    capped to scratch_size MB, or None if no directory is given.
+    """
+    if scratch_dir is None:
+        return None
+    if scratch_size is None:
+        scratch_size = DEFAULT_SCRATCH_SIZE
+    key = (os.path.abspath(scratch_dir), int(scratch_size * 2**20))
+    with _scratch_caches_lock:
+        if key not in _scratch_caches:
+            _scratch_caches[key] = ScratchCache(*key)
+        return _scratch_caches[key]